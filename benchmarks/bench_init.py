@@ -0,0 +1,88 @@
+"""Benchmark morq init with a cold and a warm mirror cache.
+
+Run it with::
+
+    make bench  # or: python benchmarks/bench_init.py [repos] [commits]
+
+Remotes are local bare repos, so this measures the git side of cloning only.
+Over a network, a warm mirror also saves the download of the history.
+"""
+import io
+import json
+import logging
+import os
+import pathlib
+import shutil
+import sys
+import tempfile
+import time
+
+import git
+
+from orquestra_manifest.morq import Manifest
+
+
+def make_remote(base, name, commits):
+    """Create a bare repo at base/remotes/name.git with some history"""
+    seed_path = base / "seeds" / name
+    seed = git.Repo.init(seed_path, initial_branch="main")
+    for index in range(commits):
+        (seed_path / f"file{index % 50}.py").write_text(f"x = {index}\n" * 200)
+        seed.index.add([f"file{index % 50}.py"])
+        seed.index.commit(f"Commit {index}")
+    remote_path = base / "remotes" / f"{name}.git"
+    seed.clone(remote_path, bare=True)
+    return remote_path
+
+
+def make_manifest(base, repos, commits):
+    """Create a workspace manifest of repos remotes"""
+    records = {}
+    for index in range(repos):
+        name = f"repo{index}"
+        records[name] = dict(url=make_remote(base, name, commits).as_uri(), ref="main")
+    manifest_file = base / "workspace" / "manifest.json"
+    manifest_file.parent.mkdir()
+    manifest_file.write_text(json.dumps(dict(version="1.0.0", repos=records)))
+    return manifest_file
+
+
+def time_init(manifest_file, use_mirror=True):
+    """Time morq init of an empty workspace"""
+    for path in manifest_file.parent.iterdir():
+        if path.is_dir():
+            shutil.rmtree(path)
+    manifest = Manifest(manifest_file, jobs=4)
+    manifest.use_mirror = use_mirror
+    manifest.output = io.StringIO()
+    start = time.perf_counter()
+    manifest.update_repos()
+    return time.perf_counter() - start
+
+
+def main():
+    repos = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    commits = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    for name in ("AUTHOR", "COMMITTER"):
+        os.environ.setdefault(f"GIT_{name}_NAME", "Morq Bench")
+        os.environ.setdefault(f"GIT_{name}_EMAIL", "bench@example.com")
+    # Every repo is missing before it is cloned.
+    logging.disable(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        base = pathlib.Path(tmp_dir)
+        os.environ["MORQ_MIRRORS"] = (base / "mirrors").as_posix()
+        manifest_file = make_manifest(base, repos, commits)
+
+        timings = dict(
+            plain=time_init(manifest_file, use_mirror=False),
+            cold=time_init(manifest_file),
+            warm=time_init(manifest_file),
+        )
+    print(f"{repos} repos of {commits} commits:")
+    for name, seconds in timings.items():
+        print(f"{name:>6s} init: {seconds:7.3f}s")
+
+
+if __name__ == "__main__":
+    main()
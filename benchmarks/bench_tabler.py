@@ -0,0 +1,44 @@
+"""Benchmark the rendering of Tabler tables.
+
+Run it with::
+
+    make bench  # or: python benchmarks/bench_tabler.py [max_rows]
+
+Rendering time should grow linearly with the number of rows.
+"""
+import sys
+import time
+
+from orquestra_manifest.tabler import Tabler
+
+STATES = ("OK", "Missing", "unchanged", "3 behind / 1 ahead", "Updated")
+
+
+def bench(rows):
+    """Time pushing rows into a Tabler, and rendering the table"""
+    start = time.perf_counter()
+    tabler = Tabler()
+    for index in range(rows):
+        tabler.push_datum(
+            dict(
+                folder=f"repo-{index}",
+                ref=f"v{index % 7}.{index % 13}.0",
+                status=STATES[index % len(STATES)],
+            )
+        )
+    table = tabler.get_table()
+    return time.perf_counter() - start, len(table)
+
+
+def main():
+    max_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rows = 1000
+    print(f"{'rows':>8s} {'seconds':>9s} {'us/row':>8s}")
+    while rows <= max_rows:
+        seconds, _ = bench(rows)
+        print(f"{rows:8d} {seconds:9.3f} {seconds / rows * 1e6:8.2f}")
+        rows *= 10
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""Persistent state for morq, kept in a .morq folder next to the manifest"""
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import sys
+import threading
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger("orquestra_manifest.cache")
+
+STATE_FOLDER = ".morq"
+
+
+def make_key(*parts):
+    """Make a stable hex digest out of JSON serializable parts"""
+    text = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class StateFile:
+    """A JSON dict stored in manifest_dir/.morq/name
+
+    * Loaded lazily, saved explicitly with save().
+    * get/set/pop are safe to call from several threads.
+    """
+
+    def __init__(self, manifest, name):
+        self.path = manifest.manifest_file.parent / STATE_FOLDER / name
+        self.lock = threading.Lock()
+        self._data = None
+
+    @property
+    def data(self):
+        """The state dict, loaded on first use"""
+        if self._data is None:
+            self._data = self.load()
+        return self._data
+
+    def load(self):
+        """Read the state from disk, an unreadable state is an empty state"""
+        if not self.path.exists():
+            return {}
+        try:
+            return json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as ex:
+            LOG.warning("Ignoring unreadable state file %s: %s", self.path, ex)
+            return {}
+
+    def save(self):
+        """Write the state to disk, atomically"""
+        with self.lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(".tmp")
+            tmp_path.write_text(
+                json.dumps(self.data, indent=2, sort_keys=True), encoding="utf-8"
+            )
+            os.replace(tmp_path, self.path)
+
+    def get(self, key, default=None):
+        """Get the value of key"""
+        with self.lock:
+            return self.data.get(key, default)
+
+    def set(self, key, value):
+        """Set the value of key"""
+        with self.lock:
+            self.data[key] = value
+
+    def pop(self, key):
+        """Remove key, if present"""
+        with self.lock:
+            self.data.pop(key, None)
+
+
+class BuildCache(StateFile):
+    """Remember the last successful build of each repo.
+
+    * A build is keyed on the repo tree fingerprint, the build command, the Python
+      environment and the keys of the repos it depends on.
+    * hits and misses are counted for the final report.
+    """
+
+    def __init__(self, manifest, name="build-state.json"):
+        super().__init__(manifest, name)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_build_key(fingerprint, command, dependency_keys=()):
+        """Make the key of a build"""
+        environment = os.environ.get("VIRTUAL_ENV") or sys.prefix
+        return make_key(fingerprint, command, environment, list(dependency_keys))
+
+    def is_fresh(self, repo_name, key):
+        """Was repo_name successfully built with key? Count the hit or miss."""
+        fresh = key is not None and self.get(repo_name) == key
+        with self.lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return fresh
+
+    def record(self, repo_name, key, success):
+        """Record the outcome of a build"""
+        if success and key is not None:
+            self.set(repo_name, key)
+        else:
+            self.pop(repo_name)
+
+    def summary(self):
+        """One line summary of the cache usage"""
+        return f"Build cache: {self.hits} hits, {self.misses} misses"
+
+
+class StatusCache(StateFile):
+    """Remember the check row of each repo, until git touches the repo.
+
+    * A row is keyed on the ref and the size and mtime of the git files that
+      change with git activity: HEAD, index, packed-refs, shallow, the ref folders
+      and the ref logs. Checking the key takes a few stat calls, no git command.
+    * hits and misses are counted for the final report.
+    """
+
+    # Files and folders of .git whose stat changes with git activity.
+    # Loose refs are written with a rename, which changes the mtime of their folder.
+    GIT_PATHS = (
+        "HEAD",
+        "index",
+        "packed-refs",
+        "shallow",
+        "refs/heads",
+        "refs/tags",
+        "refs/remotes/origin",
+    )
+
+    def __init__(self, manifest, name="status-state.json"):
+        super().__init__(manifest, name)
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def make_status_key(cls, folder_path, ref):
+        """Make the status key of the repo in folder_path, None without a .git dir"""
+        git_dir = folder_path / ".git"
+        if not git_dir.is_dir():
+            return None
+
+        stats = {}
+        paths = [git_dir / path for path in cls.GIT_PATHS]
+        for root, _folders, files in os.walk(git_dir / "logs"):
+            paths.extend(pathlib.Path(root) / file for file in files)
+        for path in paths:
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            stats[path.relative_to(git_dir).as_posix()] = [
+                stat.st_mtime_ns,
+                stat.st_size,
+            ]
+        return make_key(ref, stats)
+
+    def lookup(self, repo_name, key):
+        """Get the cached row of repo_name for key, count the hit or miss.
+
+        Return: (bool found, row)
+        """
+        entry = self.get(repo_name) if key is not None else None
+        found = entry is not None and entry.get("key") == key
+        with self.lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not found or entry.get("row") is None:
+            return found, None
+        return found, dict(entry["row"])
+
+    def record(self, repo_name, key, row):
+        """Record the row of repo_name for key"""
+        if key is not None:
+            # As pairs, the state file is saved with sorted keys.
+            pairs = list(row.items()) if row is not None else None
+            self.set(repo_name, dict(key=key, row=pairs))
+        else:
+            self.pop(repo_name)
+
+    def summary(self):
+        """One line summary of the cache usage"""
+        return f"Status cache: {self.hits} hits, {self.misses} misses"
@@ -1,11 +1,27 @@
 import argparse
+import contextlib
+import difflib
+import fnmatch
+import functools
+import json
 
 # from git.exc import GitCommandError, InvalidGitRepositoryError, NoSuchPathError
 import logging
 import re
 import os
+import pathlib
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+from git.exc import GitCommandError
+
+from orquestra_manifest.cache import StateFile, make_key
 from orquestra_manifest.morq import Manifest
+from orquestra_manifest.profiler import profiling, span
+from orquestra_manifest.tabler import Tabler
 
 logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger("orquestra_manifest.morq")
@@ -15,6 +31,10 @@ FILE_RX = re.compile(r"(?P<firstline>^.*?$)", re.M)
 COPYRIGHT_RX = re.compile(
     r"(?P<copyright>[\u00a9] Copyright \d{4}(-\d{4})? Zapata Computing Inc.).*"
 )
+# Files that get a copyright, by ending.
+EXTENSIONS = (".py", "Makefile", ".go", ".h", ".c", ".cc", ".hpp", ".cpp")
+# Copyrights are only looked for in the first HEADER_WINDOW bytes of a file.
+HEADER_WINDOW = 8 * 1024
 
 
 def write_file(file, text):
@@ -73,15 +93,43 @@ def add_copyright_to_file(copyright, text):
         return new
 
 
-def insert_copyright(first_year, last_year, file):
+def read_header(file, window=HEADER_WINDOW):
+    """Read the header of file: its complete lines within the first window bytes.
+
+    * The whole file is the header if it is no bigger than window.
+    * Bytes that are not UTF-8 are kept as surrogates, so the header round trips.
+
+    returns: (str header, int size of the header in bytes)
+    """
+    with open(file, "rb") as fp:
+        data = fp.read(window + 1)
+    if len(data) > window:
+        data = data[:window]
+        end = data.rfind(b"\n")
+        if end >= 0:
+            data = data[: end + 1]
+    return data.decode("utf-8", "surrogateescape"), len(data)
+
+
+def write_header(file, header_size, new_header):
+    """Replace the first header_size bytes of file with new_header"""
+    tmp_file = f"{file}.copyright.tmp"
+    with open(file, "rb") as src, open(tmp_file, "wb") as dst:
+        dst.write(new_header.encode("utf-8", "surrogateescape"))
+        src.seek(header_size)
+        shutil.copyfileobj(src, dst)
+    shutil.copymode(file, tmp_file)
+    os.replace(tmp_file, file)
 
-    # Read entire file data
-    with open(file, "r") as fp:
-        file_text = fp.read()
 
+def make_new_header(first_year, last_year, file, header):
+    """Get header with its copyright inserted or updated, for file.
+
+    returns: the new header, equal to header if no change is needed
+    """
     # No need to copyright an empty file.
-    if not file_text:
-        return
+    if not header:
+        return header
 
     # Prepare the year_string line.
     if first_year == last_year:
@@ -91,28 +139,26 @@ def insert_copyright(first_year, last_year, file):
 
     # replace: if there is an existing copyright, prepare a modification.
     copyright_line = make_copyright_line(year_string)
-    match = COPYRIGHT_RX.search(file_text)
+    match = COPYRIGHT_RX.search(header)
     if match:
         # Update the copyright if needed:
         if str(last_year) not in match.group("copyright"):
-            new_file_text = re.sub(COPYRIGHT_RX, copyright_line, file_text)
-            write_file(file, new_file_text)
+            return re.sub(COPYRIGHT_RX, copyright_line, header)
         # Return since we have a copyright.
-        return
+        return header
 
     # -------------------------------------------------------------------------
     # Everthing below here has no Copyright.
     # -------------------------------------------------------------------------
 
     # Now deal with scripts. They start with #! type of operators:
-    if is_script(file_text):
+    if is_script(header):
         copyright = make_pythonic_copyright(year_string)
-        new_file_text = add_copyright_to_script(copyright, file_text)
-        if new_file_text:
-            write_file(file, new_file_text)
-        else:
-            LOG.debug("Missing new_file_text for script")
-        return
+        new_header = add_copyright_to_script(copyright, header)
+        if new_header:
+            return new_header
+        LOG.debug("Missing new_file_text for script")
+        return header
 
     # The remainder are Python modules or other. Deal with accordingly.
     if file.endswith((".go", ".h", ".c", ".cc", ".hpp", ".cpp")):
@@ -120,53 +166,386 @@ def insert_copyright(first_year, last_year, file):
     else:
         copyright = make_pythonic_copyright(year_string)
 
-    match = FILE_RX.search(file_text)
-    if match:
-        new_file_text = add_copyright_to_file(copyright, file_text)
-        write_file(file, new_file_text)
-
-
-def folder_walk(repo, command):
-    """Execute cmd on pathlib.Path folder"""
-    extension = (".py", "Makefile", ".go", ".h", ".c", ".cc", ".hpp", ".cpp")
-    for dirpath, dnames, fnames in os.walk(repo.working_dir):
-        for file in fnames:
-            if file.endswith(extension):
-                path = os.path.join(dirpath, file)
-                commits = list(repo.iter_commits(paths=path))
-                if not commits:
-                    continue
-                first_year = commits[-1].committed_datetime.year
-                last_year = commits[0].committed_datetime.year
-                command(first_year, last_year, path)
+    return add_copyright_to_file(copyright, header) or header
 
 
-def copy_brand(ticket=None):
+def insert_copyright(first_year, last_year, file, dry_run=False):
+    """Insert or update the copyright of file.
 
-    manifest = Manifest("manifest.json")
-    repos = manifest.get_repos_from_manifest()
-    for repo_name, record in repos.items():
-        folder_path = manifest.get_folder_path(repo_name)
-        repo = manifest.get_valid_repo(folder_path)
-        if not repo:
-            # Log missing repo.
-            LOG.error("Missing repo %s", folder_path)
-            continue
+    * Only the header of file is read, see read_header().
+    * The file is written only when its bytes change, and never with dry_run.
+
+    returns: dict report of the change (file, first_year, last_year, diff),
+             or None if file needs no change
+    """
+    header, header_size = read_header(file)
+    new_header = make_new_header(first_year, last_year, file, header)
+    if new_header == header:
+        return None
 
+    if not dry_run:
+        write_header(file, header_size, new_header)
+
+    diff = difflib.unified_diff(
+        header.splitlines(keepends=True),
+        new_header.splitlines(keepends=True),
+        fromfile=file,
+        tofile=file,
+    )
+    return dict(
+        file=file, first_year=first_year, last_year=last_year, diff="".join(diff)
+    )
+
+
+def read_fields(stream, size=64 * 1024):
+    """Yield the NUL separated fields of a text stream, as they come"""
+    rest = ""
+    while True:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        fields = (rest + chunk).split("\0")
+        rest = fields.pop()
+        yield from fields
+    if rest:
+        yield rest
+
+
+def get_path_years(repo, follow_renames=False, paths=None):
+    """Get the first and last commit years of every path of repo.
+
+    * A single streamed 'git log -z' pass over the history, newest commit first.
+      Paths are NUL separated, so no name is quoted.
+    * With follow_renames, the history of a renamed file counts for its new name.
+    * paths limits the log to these paths, unless follow_renames is set.
+    * Raises GitCommandError if git log fails.
+
+    returns: dict of posix path relative to the repo root: (first_year, last_year)
+    """
+    command = ["git", "-C", repo.working_dir, "log", "-z"]
+    command += ["--format=%x00%cd", "--date=format:%Y"]
+    command += ["--name-status", "-M"] if follow_renames else ["--name-only"]
+    pathspec = None
+    if paths is not None and not follow_renames:
+        # Paths are read from stdin, there may be too many for the command line.
+        command += ["--stdin"]
+        pathspec = "HEAD\n--\n" + "".join(f"{path}\n" for path in paths)
+
+    years = {}
+    renamed = {}
+    year = None
+    # Each commit is "\0<year>\0\n", then its NUL terminated paths, each path
+    # after its status with follow_renames: "R100\0old\0new\0" or "M\0path\0".
+    header = started = False
+    status = None
+    names = []
+    folder_name = pathlib.Path(repo.working_dir).name
+    # Timed as the git calls of GitPython are, when profiling.
+    with span(
+        "git log", "git", repo=folder_name
+    ), tempfile.TemporaryFile() as stderr, subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE if pathspec else None,
+        stdout=subprocess.PIPE,
+        stderr=stderr,
+        encoding="utf-8",
+        errors="surrogateescape",
+    ) as proc:
+        if pathspec:
+            proc.stdin.write(pathspec)
+            proc.stdin.close()
+        for field in read_fields(proc.stdout):
+            if not field:
+                header = True
+                continue
+            if header:
+                year = int(field)
+                header = started = False
+                continue
+            if not started:
+                # The paths of a commit start after a newline.
+                field = field[1:] if field.startswith("\n") else field
+                started = True
+
+            if follow_renames:
+                if status is None:
+                    status = field
+                    continue
+                names.append(field)
+                if status.startswith(("R", "C")) and len(names) < 2:
+                    continue
+                path = renamed.get(names[-1], names[-1])
+                if status.startswith("R"):
+                    renamed[names[0]] = path
+                status = None
+                names = []
+            else:
+                path = field
+
+            if path in years:
+                years[path] = (year, years[path][1])
+            else:
+                years[path] = (year, year)
+
+        if proc.wait():
+            stderr.seek(0)
+            raise GitCommandError(
+                command, proc.returncode, stderr.read().decode(errors="replace")
+            )
+
+    return years
+
+
+def list_repo_files(repo, extensions=EXTENSIONS, include=(), exclude=()):
+    """List the files tracked by repo, with 'git ls-files'.
+
+    * Untracked and ignored trees (.git, virtualenvs, builds...) are never walked.
+    * Tracked files missing from the work tree are dropped: local deletions, and
+      files outside the folders of a sparse checkout (skip-worktree, tag "S").
+    * Only files ending with one of extensions are kept.
+    * include: if given, keep only paths matching one of these globs.
+    * exclude: drop paths matching one of these globs.
+
+    returns: list of posix paths relative to the repo root
+    """
+    output = repo.git.ls_files("-z", "-t")
+    deleted = set(repo.git.ls_files("-z", "--deleted").split("\0"))
+    paths = []
+    for entry in filter(None, output.split("\0")):
+        # Entries are "<tag> <path>".
+        tag, path = entry[0], entry[2:]
+        if tag == "S" or path in deleted:
+            continue
+        if not path.endswith(extensions):
+            continue
+        if include and not any(fnmatch.fnmatch(path, glob) for glob in include):
+            continue
+        if any(fnmatch.fnmatch(path, glob) for glob in exclude):
+            continue
+        paths.append(path)
+    return paths
+
+
+def get_changed_paths(repo, since):
+    """Get the paths changed between commit since and HEAD.
+
+    returns: set of posix paths relative to the repo root, None if since is unknown
+    """
+    try:
+        output = repo.git.diff("--name-only", "-z", f"{since}..HEAD")
+    except GitCommandError as ex:
+        LOG.warning("Can't diff %s from %s: %s", repo.working_dir, since, ex)
+        return None
+    return set(filter(None, output.split("\0")))
+
+
+def folder_walk(
+    repo,
+    command,
+    follow_renames=False,
+    jobs=1,
+    include=(),
+    exclude=(),
+    paths=None,
+):
+    """Execute command(first_year, last_year, path) on the files of repo
+
+    * Files come from list_repo_files(), filtered by the include and exclude globs.
+    * paths, if given, limits the walk to these posix paths.
+    * Up to jobs files are handled at the same time on a thread pool.
+
+    returns: list of the command results
+    """
+    files = list_repo_files(repo, include=include, exclude=exclude)
+    if paths is not None:
+        files = [rel_path for rel_path in files if rel_path in paths]
+        if not files:
+            # An empty pathspec would make git log walk the whole history.
+            return []
+        years = get_path_years(repo, follow_renames=follow_renames, paths=files)
+    else:
+        years = get_path_years(repo, follow_renames=follow_renames)
+    tasks = []
+    for rel_path in files:
+        if rel_path not in years:
+            continue
+        first_year, last_year = years[rel_path]
+        tasks.append((first_year, last_year, os.path.join(repo.working_dir, rel_path)))
+
+    if jobs <= 1:
+        return [command(*task) for task in tasks]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(lambda task: command(*task), tasks))
+
+
+def brand_repo(
+    repo,
+    ticket,
+    follow_renames=False,
+    jobs=1,
+    push=True,
+    dry_run=False,
+    include=(),
+    exclude=(),
+    since=None,
+):
+    """Stamp the copyright on the files of repo, in branch ticket.
+
+    * If since is a commit, only the files changed from since to HEAD are stamped.
+    * The changes are committed, and pushed to origin if push is True.
+    * With dry_run, the repo is left alone: no checkout, no write, no commit.
+
+    returns: (dict summary row for Tabler, list of insert_copyright reports)
+    """
+    start = time.perf_counter()
+    folder_name = pathlib.Path(repo.working_dir).name
+
+    if not dry_run:
         if ticket in repo.refs:
             repo.git.checkout(ticket)
         else:
             repo.git.checkout("-b", ticket)
 
-        folder_walk(
+    paths = get_changed_paths(repo, since) if since else None
+    command = functools.partial(insert_copyright, dry_run=dry_run)
+    with span("stamp", "phase", repo=folder_name):
+        results = folder_walk(
+            repo,
+            command,
+            follow_renames=follow_renames,
+            jobs=jobs,
+            include=include,
+            exclude=exclude,
+            paths=paths,
+        )
+    reports = [result for result in results if result]
+    for report in reports:
+        report["path"] = os.path.relpath(report["file"], repo.working_dir)
+
+    if reports and not dry_run:
+        with span("commit", "phase", repo=folder_name):
+            repo.git.add(update=True)
+            commit_message = f"Add Copyright for ticket: {ticket}"
+            repo.index.commit(commit_message)
+            if push:
+                repo.git.push("origin", ticket)
+                LOG.info("Repo %s.%s has is ready for a PR", folder_name, ticket)
+
+    row = dict(
+        folder=folder_name,
+        changed=str(len(reports)),
+        skipped=str(len(results) - len(reports)),
+        seconds=f"{time.perf_counter() - start:.2f}",
+    )
+    return row, reports
+
+
+def make_filter_key(extensions=EXTENSIONS, include=(), exclude=()):
+    """Make the key of the files a run looks at: its extensions and globs"""
+    return make_key(list(extensions), sorted(include), sorted(exclude))
+
+
+def get_last_stamped(state, repo_name, filter_key):
+    """Get the commit last stamped in repo_name with the files of filter_key, or None"""
+    entry = state.get(repo_name)
+    if isinstance(entry, dict) and entry.get("key") == filter_key:
+        return entry.get("commit")
+    return None
+
+
+def get_file_jobs(jobs, repo_count):
+    """Get the files handled at the same time per repo, out of jobs in all.
+
+    * jobs is the -j of the repos: 0 runs every repo at the same time.
+    """
+    workers = min(jobs or repo_count, repo_count)
+    return max(1, (jobs or 1) // max(1, workers))
+
+
+def copy_brand(
+    ticket=None,
+    follow_renames=False,
+    jobs=1,
+    push=True,
+    manifest_file="manifest.json",
+    dry_run=False,
+    report="diff",
+    include=(),
+    exclude=(),
+    full=False,
+    file_jobs=None,
+):
+    """Stamp the copyright on every manifest repo.
+
+    * Up to jobs repos are handled at the same time, all of them if jobs is 0, as
+      with morq -j.
+    * Up to file_jobs files of each repo are handled at the same time. By default,
+      the jobs left over by the repos are shared by their files, so about jobs
+      threads run in all, not jobs * jobs.
+    * A summary table of files changed, files skipped and time taken is printed.
+    * Only the files matching the include globs, and none of the exclude globs, are
+      stamped.
+    * The last commit stamped in each repo is kept in .morq/copyright-state.json, a
+      later run only looks at the files changed since, unless full is set. The
+      commit is kept with the include and exclude globs of its run: a run with other
+      globs looks at all of its files.
+    * With dry_run nothing is written. The changes are printed as a unified diff, or
+      as a JSON report of repo: [changes] if report is "json".
+    """
+    manifest = Manifest(manifest_file, jobs=jobs)
+    repos = manifest.get_repos_from_manifest()
+    tabler = Tabler()
+    all_reports = {}
+    state = StateFile(manifest, "copyright-state.json")
+    filter_key = make_filter_key(include=include, exclude=exclude)
+    if file_jobs is None:
+        file_jobs = get_file_jobs(jobs, len(repos))
+
+    def brand(repo_name, _record):
+        folder_path = manifest.get_folder_path(repo_name)
+        repo = manifest.get_valid_repo(folder_path)
+        if not repo:
+            # Log missing repo.
+            LOG.error("Missing repo %s", folder_path)
+            return None, []
+        row, reports = brand_repo(
             repo,
-            insert_copyright,
+            ticket,
+            follow_renames=follow_renames,
+            jobs=file_jobs,
+            push=push,
+            dry_run=dry_run,
+            include=include,
+            exclude=exclude,
+            since=None if full else get_last_stamped(state, repo_name, filter_key),
         )
-        repo.git.add(update=True)
-        commit_message = f"Add Copyright for ticket: {ticket}"
-        repo.index.commit(commit_message)
-        repo.git.push("origin", ticket)
-        LOG.info("Repo %s.%s has is ready for a PR", folder_path.stem, ticket)
+        if not dry_run:
+            state.set(repo_name, dict(key=filter_key, commit=repo.head.commit.hexsha))
+        return row, reports
+
+    def on_error(repo_name, _record, _ex):
+        row = dict(folder=repo_name, changed="Failed", skipped="N/A", seconds="N/A")
+        return row, []
+
+    results = manifest.map_repos(brand, repos, on_error=on_error)
+    for repo_name, (datum, reports) in zip(repos, results):
+        if datum:
+            tabler.push_datum(datum)
+            all_reports[repo_name] = reports
+    if not dry_run:
+        state.save()
+
+    if dry_run and report == "json":
+        print(json.dumps(all_reports, indent=2))
+        return
+
+    if dry_run:
+        for reports in all_reports.values():
+            for _report in reports:
+                print(_report["diff"], end="")
+
+    if tabler.data:
+        print(tabler.get_table())
 
 
 def copyright():
@@ -175,6 +554,87 @@ def copyright():
     parser.add_argument(
         "--ticket", dest="ticket", type=str, help="ticket to label the branch"
     )
+    parser.add_argument(
+        "--follow-renames",
+        action="store_true",
+        help="count the history of renamed files for the copyright years",
+    )
+    parser.add_argument(
+        "-m",
+        "--manifest_file",
+        default="manifest.json",
+        help="Alternative location of the manifest file",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of repos to process at the same time (0: all of them)",
+    )
+    parser.add_argument(
+        "--file-jobs",
+        type=int,
+        default=None,
+        help="Number of files per repo to process at the same time, by default the "
+        "jobs the repos leave over",
+    )
+    parser.add_argument(
+        "--no-push",
+        dest="push",
+        action="store_false",
+        help="commit the changes, but don't push them to origin",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="write nothing, report the changes that would be made",
+    )
+    parser.add_argument(
+        "--report",
+        choices=["diff", "json"],
+        default="diff",
+        help="format of the --dry-run report",
+    )
+    parser.add_argument(
+        "--include",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="only stamp files matching GLOB, can be repeated",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="don't stamp files matching GLOB, can be repeated",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="look at every file, not only those changed since the last run",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        default=None,
+        help="time git calls and repos, and write a Chrome trace to PATH",
+    )
     args = parser.parse_args()
     ticket = args.ticket
-    copy_brand(ticket=ticket)
+    profile = profiling(args.profile) if args.profile else contextlib.nullcontext()
+    with profile:
+        copy_brand(
+            ticket=ticket,
+            follow_renames=args.follow_renames,
+            jobs=max(0, args.jobs),
+            push=args.push,
+            manifest_file=args.manifest_file,
+            dry_run=args.dry_run,
+            report=args.report,
+            include=args.include,
+            exclude=args.exclude,
+            full=args.full,
+            file_jobs=None if args.file_jobs is None else max(1, args.file_jobs),
+        )
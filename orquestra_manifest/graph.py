@@ -0,0 +1,150 @@
+"""Dependency graph of manifest repos"""
+import configparser
+import logging
+import re
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger("orquestra_manifest.graph")
+
+REQUIREMENT_RX = re.compile(r"^\s*(?P<name>[A-Za-z0-9][A-Za-z0-9._\-]*)")
+
+
+def normalize_name(name):
+    """Normalize a package or repo name, per PEP 503"""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _requirement_names(requirements):
+    """Get the normalized package names out of a list of requirement strings"""
+    names = set()
+    for requirement in requirements:
+        match = REQUIREMENT_RX.match(requirement)
+        if match:
+            names.add(normalize_name(match.group("name")))
+    return names
+
+
+def get_package_metadata(folder_path):
+    """Get the package name of the repo in folder_path, and the packages it requires.
+
+    * Reads setup.cfg [metadata] name and [options] install_requires.
+    * Reads pyproject.toml [project] name and dependencies, and [tool.poetry] name
+      and dependencies, if a TOML parser is available.
+
+    returns: (normalized package name or None, set of normalized package names)
+    """
+    name = None
+    names = set()
+
+    setup_cfg = folder_path / "setup.cfg"
+    if setup_cfg.exists():
+        config = configparser.ConfigParser()
+        try:
+            config.read(setup_cfg, encoding="utf-8")
+            requires = config.get("options", "install_requires", fallback="")
+            name = config.get("metadata", "name", fallback=None)
+        except configparser.Error as ex:
+            LOG.warning("Can't read %s: %s", setup_cfg, ex)
+        else:
+            names |= _requirement_names(requires.splitlines())
+
+    pyproject = folder_path / "pyproject.toml"
+    if pyproject.exists() and not tomllib:
+        LOG.warning("Skipping %s, install tomli to read it", pyproject)
+    elif pyproject.exists():
+        try:
+            with pyproject.open("rb") as _fd:
+                data = tomllib.load(_fd)
+        except (OSError, ValueError) as ex:
+            LOG.warning("Can't read %s: %s", pyproject, ex)
+        else:
+            project = data.get("project", {})
+            poetry = data.get("tool", {}).get("poetry", {})
+            name = project.get("name") or poetry.get("name") or name
+            names |= _requirement_names(project.get("dependencies", []))
+            names |= _requirement_names(poetry.get("dependencies", {}))
+
+    return (normalize_name(name) if name else None), names
+
+
+def get_package_requirements(folder_path):
+    """Get the package names required by the repo in folder_path.
+
+    * See get_package_metadata() for the files read.
+
+    returns: set of normalized package names
+    """
+    return get_package_metadata(folder_path)[1]
+
+
+def get_dependencies(manifest, repos):
+    """Get the manifest repos that each manifest repo depends on.
+
+    * An explicit "depends_on" list in the manifest entry wins.
+    * Otherwise dependencies are inferred from the package metadata of the repo.
+      Repos are known by the package name they declare, else by their folder name.
+
+    returns: dict of repo_name: list of repo_names, in manifest order
+    """
+    metadata = {
+        repo_name: get_package_metadata(manifest.get_folder_path(repo_name))
+        for repo_name in repos
+    }
+    by_package = {
+        metadata[repo_name][0] or normalize_name(repo_name): repo_name
+        for repo_name in repos
+    }
+    dependencies = {}
+
+    for repo_name, record in repos.items():
+        if "depends_on" in record:
+            depends_on = []
+            for name in record.get("depends_on") or []:
+                if name in repos:
+                    depends_on.append(name)
+                else:
+                    LOG.warning("Repo %s depends on unknown repo %s", repo_name, name)
+        else:
+            required = metadata[repo_name][1]
+            depends_on = [by_package[name] for name in required if name in by_package]
+
+        dependencies[repo_name] = [
+            name for name in repos if name in depends_on and name != repo_name
+        ]
+
+    return dependencies
+
+
+def get_build_levels(dependencies):
+    """Sort repos into levels: every repo only depends on repos of earlier levels.
+
+    dependencies: dict of repo_name: list of repo_names
+    returns: (list of levels, each a list of repo_names; list of repo_names in or
+              behind a cycle, which can't be scheduled)
+    """
+    remaining = {name: set(deps) for name, deps in dependencies.items()}
+    levels = []
+
+    while remaining:
+        level = [name for name, deps in remaining.items() if not deps]
+        if not level:
+            break
+        levels.append(level)
+        for name in level:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(level)
+
+    cyclic = list(remaining)
+    if cyclic:
+        LOG.critical("Dependency cycle between repos: %s", ", ".join(cyclic))
+
+    return levels, cyclic
@@ -0,0 +1,155 @@
+"""Shared mirror cache of remote repos, to clone manifest repos from"""
+import contextlib
+import hashlib
+import logging
+import os
+import pathlib
+
+import git
+from git.exc import GitCommandError
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from orquestra_manifest.profiler import span
+from orquestra_manifest.utils import rm_tree, set_sparse
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger("orquestra_manifest.mirror")
+
+
+def get_mirror_root():
+    """Get the folder of the mirrors.
+
+    * $MORQ_MIRRORS if set, else $XDG_CACHE_HOME/morq/mirrors, else
+      ~/.cache/morq/mirrors
+    """
+    if os.environ.get("MORQ_MIRRORS"):
+        return pathlib.Path(os.environ["MORQ_MIRRORS"])
+    cache_home = os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache"
+    return pathlib.Path(cache_home) / "morq" / "mirrors"
+
+
+def get_mirror_path(url):
+    """Get the path of the mirror of url"""
+    digest = hashlib.sha256(str(url).encode()).hexdigest()[:16]
+    return get_mirror_root() / f"{digest}.git"
+
+
+@contextlib.contextmanager
+def mirror_lock(mirror_path):
+    """Hold the lock of a mirror, shared by threads and processes.
+
+    * The wait for the lock is a span of the profile, if any.
+    """
+    mirror_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(mirror_path.with_suffix(".lock"), "w", encoding="utf-8") as lock_fd:
+        with span(mirror_path.name, "wait"):
+            lock_file(lock_fd)
+        try:
+            yield
+        finally:
+            unlock_file(lock_fd)
+
+
+def lock_file(lock_fd):
+    """Wait for the exclusive lock of an open file"""
+    if fcntl:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        return
+    while True:
+        try:
+            # Retries for 10 seconds, then raises.
+            msvcrt.locking(lock_fd.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+
+def unlock_file(lock_fd):
+    """Release the lock of lock_file()"""
+    if fcntl:
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
+    else:
+        msvcrt.locking(lock_fd.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def update_mirror(url):
+    """Create or refresh the bare mirror of url.
+
+    returns: pathlib.Path of the mirror
+    """
+    mirror_path = get_mirror_path(url)
+    with mirror_lock(mirror_path):
+        if mirror_path.is_dir():
+            LOG.info("Refreshing mirror of %s", url)
+            git.Repo(mirror_path).git.fetch("--prune", "origin")
+            return mirror_path
+
+        LOG.info("Creating mirror of %s in %s", url, mirror_path)
+        tmp_path = mirror_path.with_suffix(".tmp")
+        if tmp_path.exists():
+            rm_tree(tmp_path)
+        with span("git clone", "git", repo=mirror_path.name, url=url):
+            git.Repo.clone_from(url, tmp_path, mirror=True)
+        os.replace(tmp_path, mirror_path)
+        return mirror_path
+
+
+def get_clone_options(record):
+    """Get the clone options of a manifest record: its depth, filter and sparse"""
+    options = {}
+    if record.get("depth"):
+        options["depth"] = int(record["depth"])
+        # Shallow clones have a single branch by default, any branch may be the ref.
+        options["no_single_branch"] = True
+    if record.get("filter"):
+        options["filter"] = record["filter"]
+    if record.get("sparse"):
+        # The work tree is checked out once sparse.
+        options["no_checkout"] = True
+    return options
+
+
+def clone_repo(url, folder_path, record=None, use_mirror=True):
+    """Clone url into folder_path, out of the mirror of url when possible.
+
+    * Full clones of the mirror are local clones: their objects are hardlinks to
+      the mirror ones, so they cost little time and disk, and do not break if the
+      mirror is deleted.
+    * The depth and filter of record make a shallow or partial clone of url. These
+      never use the mirror, which holds the full history of url.
+    * The sparse folders of record limit the work tree.
+    * origin points to url in the end, as with a plain clone.
+    * Falls back to a plain clone of url if the mirror can't be used, or can't be
+      cloned.
+    * Each clone is a span of the profile, if any.
+
+    returns: git.Repo
+    """
+    record = record or {}
+    options = get_clone_options(record)
+    repo = None
+    existed = folder_path.exists()
+    if use_mirror and not ("depth" in options or "filter" in options):
+        try:
+            mirror_path = update_mirror(url)
+            source = mirror_path.as_posix()
+            with span("git clone", "git", repo=folder_path.name, url=source):
+                repo = git.Repo.clone_from(source, folder_path, **options)
+            repo.remotes.origin.set_url(url)
+        except (GitCommandError, OSError) as ex:
+            LOG.warning("Not using a mirror of %s: %s", url, ex)
+            repo = None
+            if not existed and folder_path.exists():
+                rm_tree(folder_path)
+
+    if repo is None:
+        with span("git clone", "git", repo=folder_path.name, url=url):
+            repo = git.Repo.clone_from(url, folder_path, **options)
+    if record.get("sparse"):
+        set_sparse(repo, record["sparse"])
+    return repo
@@ -1,25 +1,47 @@
 """Common Tools for Orquestra-Manifest"""
 
 import argparse
+import contextlib
 import json
 import logging
 import pathlib
 import sys
 import textwrap
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import argcomplete
 import git
 from git.exc import GitCommandError, InvalidGitRepositoryError, NoSuchPathError
 
+from orquestra_manifest.cache import BuildCache, StateFile, StatusCache
+from orquestra_manifest.graph import get_build_levels, get_dependencies
+from orquestra_manifest.mirror import clone_repo
+from orquestra_manifest.profiler import profiling, span
+from orquestra_manifest.remote import (
+    PER_HOST,
+    HostLimiter,
+    fetch_repo,
+    get_remote_host,
+    get_ssh_command,
+)
+from orquestra_manifest.runner import cancel_all
 from orquestra_manifest.sphinx_tools import install_sphinx, update_sphinx_conf
-from orquestra_manifest.tabler import Tabler
+from orquestra_manifest.tabler import FORMATS, Tabler
 from orquestra_manifest.utils import (
+    fetch_ref,
     folder_cmd,
-    get_repo_ref_state_ok,
-    get_repo_ref_type,
+    get_repo_state,
+    get_tag_name,
+    get_tree_fingerprint,
+    git_fast_forward,
     git_pull_change,
+    is_shallow,
+    message_scope,
     ref_in_refs,
     rm_tree,
+    set_sparse,
+    tree_changed_since,
 )
 
 logging.basicConfig(level=logging.INFO)
@@ -29,8 +51,33 @@ LOG = logging.getLogger("orquestra_manifest.morq")
 class Manifest:
     """Manifest class to manage package groups"""
 
-    def __init__(self, manifest=None):
+    def __init__(
+        self,
+        manifest=None,
+        jobs=1,
+        use_cache=True,
+        stream=False,
+        output_format="table",
+    ):
         self.manifest_file = None
+        self.jobs = jobs
+        self.use_cache = use_cache
+        self.stream = stream
+        self.output_format = output_format
+        # Where tables go, None is sys.stdout.
+        self.output = None
+        self.affected = False
+        self.fetch = True
+        self.per_host = PER_HOST
+        self.use_mirror = True
+        # Seconds after which build and test commands are stopped, None for never.
+        self.timeout = None
+        # Add a "seconds" column to the tables, of the time each repo took.
+        self.timings = False
+        # Path of the Chrome trace written by parse_args, None for none.
+        self.profile = None
+        # Seconds each repo took, in its last map_repos().
+        self.elapsed = {}
         if manifest and pathlib.Path(manifest).exists():
             self.manifest_file = pathlib.Path(manifest).resolve()
 
@@ -57,6 +104,55 @@ class Manifest:
             default=default_manifest_file,
             help="Alternative location of the manifest file",
         )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=None,
+            help="Number of repos to process at the same time (0: all of them). "
+            "Default: 1, all of them for fetch",
+        )
+        parser.add_argument(
+            "--no-cache",
+            dest="use_cache",
+            action="store_false",
+            help="Ignore the state cached in .morq/ next to the manifest",
+        )
+        parser.add_argument(
+            "--no-mirror",
+            dest="use_mirror",
+            action="store_false",
+            help="Clone missing repos from their urls, not from the mirror cache",
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            default=None,
+            help="Stop build and test commands running longer than this, in seconds",
+        )
+        parser.add_argument(
+            "--timings",
+            action="store_true",
+            help="Add the seconds each repo took to the results",
+        )
+        parser.add_argument(
+            "--profile",
+            metavar="PATH",
+            default=None,
+            help="Time git calls, commands and repos, and write a Chrome trace to PATH",
+        )
+        parser.add_argument(
+            "--stream",
+            action="store_true",
+            help="Print each repo row as soon as it is ready, then the final table",
+        )
+        parser.add_argument(
+            "--format",
+            dest="output_format",
+            choices=FORMATS,
+            default="table",
+            help="Output format of the results, ndjson is streamed row by row",
+        )
 
         subparsers = parser.add_subparsers()
 
@@ -70,6 +166,11 @@ class Manifest:
         parser_build.set_defaults(func=self.build_repos_dev)
 
         parser_build = subparsers.add_parser("test")
+        parser_build.add_argument(
+            "--affected",
+            action="store_true",
+            help="Only build and test repos changed since their last green test",
+        )
         parser_build.set_defaults(func=self.test_repos)
 
         parser_check = subparsers.add_parser("check")
@@ -82,8 +183,27 @@ class Manifest:
         parser_purge.set_defaults(func=self.purge_repos)
 
         parser_update = subparsers.add_parser("update")
+        parser_update.add_argument(
+            "--no-fetch",
+            dest="fetch",
+            action="store_false",
+            help="Fast-forward to the remote branches of the last 'morq fetch' only",
+        )
         parser_update.set_defaults(func=self.update_repos)
 
+        parser_fetch = subparsers.add_parser(
+            "fetch",
+            description="Fetch every repo from its remote. Without -j, all repos are "
+            "fetched at the same time, at most --per-host of them from each host.",
+        )
+        parser_fetch.add_argument(
+            "--per-host",
+            type=int,
+            default=PER_HOST,
+            help="Number of repos to fetch from the same host at the same time",
+        )
+        parser_fetch.set_defaults(func=self.fetch_repos, default_jobs=0)
+
         parser_sphinx = subparsers.add_parser("sphinx")
         parser_sphinx.set_defaults(func=self.init_sphinx)
 
@@ -107,8 +227,31 @@ class Manifest:
             )
             sys.exit(1)
 
+        jobs = args.jobs if args.jobs is not None else getattr(args, "default_jobs", 1)
+        self.jobs = max(0, jobs)
+        self.use_cache = args.use_cache
+        self.use_mirror = args.use_mirror
+        self.timeout = args.timeout
+        self.profile = args.profile
+        self.timings = args.timings or bool(args.profile)
+        self.stream = args.stream
+        self.output_format = args.output_format
+        self.affected = getattr(args, "affected", False)
+        self.fetch = getattr(args, "fetch", True)
+        self.per_host = getattr(args, "per_host", PER_HOST)
+
+        # Machine readable results alone go to stdout, the rest goes to stderr.
+        self.output = sys.stdout
+        redirect = contextlib.nullcontext()
+        if self.output_format != "table":
+            redirect = contextlib.redirect_stdout(sys.stderr)
+        profile = profiling(self.profile) if self.profile else contextlib.nullcontext()
+
         try:
-            args.func()
+            with redirect, message_scope() as messages, profile:
+                args.func()
+                if messages.suppressed:
+                    print(messages.summary())
         except AttributeError:
             parser.print_help()
             parser.exit()
@@ -131,97 +274,129 @@ class Manifest:
 
     @staticmethod
     def get_commits_behind_or_ahead(repo, ref):
-        """Get number of commits behind or ahead
+        """Get number of commits behind and ahead of ref
 
-        Returns:
-          * negative integer for behind count
-          * positive integer for ahead count
-        """
+        * Branches are compared to their "origin/" remote branch, if there is one.
+        * Commits are counted by 'git rev-list --left-right --count', not walked.
 
-        behind = -1 * sum(1 for x in repo.iter_commits(".." + ref))
-        if behind:
-            return behind
+        Returns: (int behind, int ahead)
+        """
+        state = get_repo_state(repo, ref, check_dirty=False)
+        return state.behind, state.ahead
 
-        ahead = sum([1 for x in (repo.iter_commits(f"{ref}@{{u}}..{ref}"))])
-        if ahead:
-            return ahead
+    @staticmethod
+    def format_commit_delta(state):
+        """Format the behind/ahead counts of a RepoState for the table.
 
-        return 0
+        * Counts cut by a shallow history are lower bounds, marked with a "+".
+        """
+        more = "" if state.exact else "+"
+        return f"{state.behind}{more} behind / {state.ahead}{more} ahead"
 
     def check_repos(self):
         """Check all repos:
 
         * Report on out-of-sync repos if possible.
+        * Repos are checked on a pool of self.jobs workers. Rows are logged, or
+          streamed with self.stream, as each repo finishes. The final table is in
+          manifest order.
+        * Rows are cached in .morq/status-state.json, until git touches the repo.
+          Only the repos whose git files changed are checked again, unless
+          self.use_cache is False.
         """
         repos = self.get_repos_from_manifest()
         tabler = Tabler()
+        stream = self.get_stream(repos)
+        status_cache = StatusCache(self)
 
-        # Iterate through all Git folders and try to initialize them in a simple way.
-        for repo_name, record in repos.items():
+        def check(repo_name, record):
             folder_path = self.get_folder_path(repo_name)
             ref = record.get("ref")
-            repo = self.get_valid_repo(folder_path)
-            if not repo:
-                # Log missing repo.
-                LOG.debug("Missing repo %s", folder_path)
-                tabler.push_datum(
-                    dict(
-                        folder=folder_path.name,
-                        ref=ref,
-                        position="None",
-                        status="Missing",
-                    )
-                )
-                continue
+            if self.use_cache:
+                key = StatusCache.make_status_key(folder_path, ref)
+                found, datum = status_cache.lookup(repo_name, key)
+                if found:
+                    return datum
+            datum = self.check_repo(repo_name, record)
+            # git may refresh the index while checking, key the state it left.
+            status_cache.record(
+                repo_name, StatusCache.make_status_key(folder_path, ref), datum
+            )
+            return datum
+
+        def on_result(repo_name, datum):
+            if datum:
+                LOG.info("Checked %s: %s", repo_name, datum.get("status"))
+                self.stream_datum(stream, self.timed(repo_name, datum))
+
+        def on_error(repo_name, record, _ex):
+            return dict(
+                folder=repo_name,
+                ref=record.get("ref"),
+                position="invalid",
+                status="Failed",
+            )
 
-            # Repo ref is invalid, skip:
-            if not ref_in_refs(repo, ref):
-                tabler.push_datum(
-                    dict(
-                        folder=folder_path.name,
-                        ref=ref,
-                        position="invalid",
-                        status="invalid",
-                    )
-                )
-                continue
+        results = self.map_repos(check, repos, on_error=on_error, on_result=on_result)
+        for repo_name, datum in zip(repos, results):
+            if datum:
+                tabler.push_datum(self.timed(repo_name, datum))
+        status_cache.save()
+        self.end_stream(stream)
+        self.print_table(tabler, stream)
+        if self.use_cache:
+            LOG.info(status_cache.summary())
 
-            # If a Git repo is in good status, don't do anything...
-            state_ok = get_repo_ref_state_ok(repo, ref)
-            if state_ok:
-                tabler.push_datum(
-                    dict(folder=folder_path.name, ref=ref, position=ref, status="OK")
-                )
-                continue
+    def check_repo(self, repo_name, record):
+        """Check a single manifest repo.
 
-            # All else is either behind or ahead. Find out.
-            commit_delta = self.get_commits_behind_or_ahead(repo, ref)
-            if commit_delta:
-                if commit_delta < 0:
-                    status = f"{commit_delta} behind"
-                else:
-                    status = f"{commit_delta} ahead"
+        Return: dict Tabler row, or None when there is nothing to report.
+        """
+        folder_path = self.get_folder_path(repo_name)
+        ref = record.get("ref")
+        repo = self.get_valid_repo(folder_path)
+        if not repo:
+            # Log missing repo.
+            LOG.debug("Missing repo %s", folder_path)
+            return dict(
+                folder=folder_path.name,
+                ref=ref,
+                position="None",
+                status="Missing",
+            )
 
-                tabler.push_datum(
-                    dict(
-                        folder=folder_path.name,
-                        ref=ref,
-                        position=repo.commit().hexsha[:8],
-                        status=status,
-                    )
-                )
-                continue
+        # Repo ref is invalid, skip:
+        if not ref_in_refs(repo, ref):
+            return dict(
+                folder=folder_path.name,
+                ref=ref,
+                position="invalid",
+                status="invalid",
+            )
 
-            if repo.is_dirty():
-                tabler.push_datum(
-                    dict(
-                        folder=folder_path.name,
-                        ref=ref,
-                        position="invalid",
-                        status="Dirty",
-                    )
-                )
-        print(tabler.get_table())
+        # If a Git repo is in good status, don't do anything...
+        state = get_repo_state(repo, ref)
+        if state.ok:
+            return dict(folder=folder_path.name, ref=ref, position=ref, status="OK")
+
+        # All else is either behind or ahead. Find out.
+        if state.behind or state.ahead:
+            return dict(
+                folder=folder_path.name,
+                ref=ref,
+                position=state.head_sha[:8],
+                status=self.format_commit_delta(state),
+            )
+
+        if state.dirty:
+            return dict(
+                folder=folder_path.name,
+                ref=ref,
+                position="invalid",
+                status="Dirty",
+            )
+
+        return None
 
     def purge_repos(self):
         """Purge (delete) all repos found in folder_path:
@@ -241,140 +416,319 @@ class Manifest:
 
         * Warning: will overwrite temporary work.
         * Do not update the manifest automatically. You should do it externally.
+        * Repos are updated on a pool of self.jobs workers, rows are streamed as
+          each repo finishes with self.stream.
         """
         repos = self.get_repos_from_manifest()
         tabler = Tabler()
+        stream = self.get_stream(repos)
+
+        def on_result(repo_name, datum):
+            self.stream_datum(stream, self.timed(repo_name, datum))
+
+        def on_error(repo_name, record, _ex):
+            return dict(
+                folder=repo_name,
+                ref=record.get("ref"),
+                position="Invalid",
+                status="Failed",
+                update="N/A",
+            )
+
+        results = self.map_repos(
+            self.update_repo, repos, on_error=on_error, on_result=on_result
+        )
+        for repo_name, datum in zip(repos, results):
+            if datum:
+                tabler.push_datum(self.timed(repo_name, datum))
+
+        self.end_stream(stream)
+        self.print_table(tabler, stream)
+
+    def fetch_repos(self):
+        """Fetch all repos from their remotes, without touching their work trees.
 
-        # Iterate through all Git folders and try to initialize them in a simple way.
-        for repo_name, record in repos.items():
+        * Repos are fetched on a pool of self.jobs workers, with at most
+          self.per_host of them talking to the same host at a time. Without -j, the
+          command line fetches all repos at the same time: per_host is the bound.
+        * SSH remotes share one connection per host (SSH ControlMaster).
+        * Follow with 'update --no-fetch' to fast-forward the work trees.
+        """
+        repos = self.get_repos_from_manifest()
+        tabler = Tabler()
+        stream = self.get_stream(repos)
+        limiter = HostLimiter(self.per_host)
+        env = dict(GIT_SSH_COMMAND=get_ssh_command())
+
+        def fetch(repo_name, record):
             folder_path = self.get_folder_path(repo_name)
-            ref = record.get("ref")
+            host = get_remote_host(record.get("url"))
             repo = self.get_valid_repo(folder_path)
             if not repo:
-                # Log missing repo.
-                LOG.warning(
-                    "Missing repo %s" "\n\t=> Attempting to clone....", folder_path
-                )
-                # Clone the repo, because its missing
-                LOG.info("Cloning repo %s", folder_path)
-                url = record.get("url")
-                try:
-                    repo = git.Repo.clone_from(url, folder_path)
-                except GitCommandError as ex:
-                    LOG.critical("  => URL %s does not exist!", url)
-                    LOG.debug("Full URL error: %s", ex)
-                    tabler.push_datum(
-                        dict(
-                            folder=folder_path.name,
-                            ref=ref,
-                            position="Invalid",
-                            status="Invalid",
-                            update="N/A",
-                        )
-                    )
-                    continue
-
-                # You cloned the repo, now checkout the reference.
-                try:
-                    repo.git.checkout(ref)
-                except GitCommandError as ex:
-                    LOG.critical("  => Git Ref %s does not exist!: %s", ref, ex)
-                    LOG.debug("Full Ref error: %s", ex)
-                    tabler.push_datum(
-                        dict(
-                            folder=folder_path.name,
-                            ref=ref,
-                            position="Invalid",
-                            status="Invalid",
-                            update="New",
-                        )
-                    )
-                    continue
-                else:
-                    tabler.push_datum(
-                        dict(
-                            folder=folder_path.name,
-                            ref=ref,
-                            position=ref,
-                            status="OK",
-                            update="New",
-                        )
-                    )
-                    continue
-
-            # Repo is valid.
-            # Check that the ref exists here first
-            if not ref_in_refs(repo, ref):
-                tabler.push_datum(
-                    dict(
-                        folder=folder_path.name,
-                        ref=ref,
-                        position="invalid",
-                        status="invalid",
-                        update="N/A",
-                    )
+                LOG.debug("Missing repo %s", folder_path)
+                return dict(folder=repo_name, host=host, fetch="Missing")
+            with limiter.limit(host):
+                LOG.info("Fetching %s from %s", repo_name, host)
+                return dict(folder=repo_name, host=host, fetch=fetch_repo(repo, env))
+
+        def on_result(repo_name, datum):
+            self.stream_datum(stream, self.timed(repo_name, datum))
+
+        def on_error(repo_name, record, _ex):
+            host = get_remote_host(record.get("url"))
+            return dict(folder=repo_name, host=host, fetch="Failed")
+
+        results = self.map_repos(fetch, repos, on_error=on_error, on_result=on_result)
+        for repo_name, datum in zip(repos, results):
+            tabler.push_datum(self.timed(repo_name, datum))
+        self.end_stream(stream)
+        self.print_table(tabler, stream)
+
+    def update_repo(self, repo_name, record):
+        """Clone, pull and checkout a single manifest repo.
+
+        * Missing repos are cloned out of the mirror cache, unless not
+          self.use_mirror. The depth and filter of record make a shallow or partial
+          clone of the url, without the mirror.
+        * The sparse folders of record limit the work tree, on clone and update.
+        * Shallow repos are updated with the new commits only, so their history
+          stays connected and their status exact. Tags and commits they lack are
+          fetched with the depth of record.
+
+        Return: dict Tabler row, or None when there is nothing to report.
+        """
+        folder_path = self.get_folder_path(repo_name)
+        ref = record.get("ref")
+        repo = self.get_valid_repo(folder_path)
+        if not repo:
+            # Log missing repo.
+            LOG.warning("Missing repo %s" "\n\t=> Attempting to clone....", folder_path)
+            # Clone the repo, because its missing
+            LOG.info("Cloning repo %s", folder_path)
+            url = record.get("url")
+            try:
+                with span("clone", "phase", repo=repo_name):
+                    repo = clone_repo(url, folder_path, record, self.use_mirror)
+            except GitCommandError as ex:
+                LOG.critical("  => URL %s does not exist!", url)
+                LOG.debug("Full URL error: %s", ex)
+                return dict(
+                    folder=folder_path.name,
+                    ref=ref,
+                    position="Invalid",
+                    status="Invalid",
+                    update="N/A",
                 )
-                continue
 
-            update_status = git_pull_change(repo, ref)
-            if update_status == "invalid":
-                tabler.push_datum(
-                    dict(
-                        folder=folder_path.name,
-                        ref=ref,
-                        position=ref,
-                        status="invalid",
-                        update=update_status,
-                    )
+            # You cloned the repo, now checkout the reference.
+            try:
+                self.get_shallow_ref(repo, record)
+                repo.git.checkout(ref)
+            except GitCommandError as ex:
+                LOG.critical("  => Git Ref %s does not exist!: %s", ref, ex)
+                LOG.debug("Full Ref error: %s", ex)
+                return dict(
+                    folder=folder_path.name,
+                    ref=ref,
+                    position="Invalid",
+                    status="Invalid",
+                    update="New",
                 )
-                continue
 
-            # If a Git repo is in good status, check for changes
-            state_ok = get_repo_ref_state_ok(repo, ref)
-            if state_ok:
-                tabler.push_datum(
-                    dict(
-                        folder=folder_path.name,
-                        ref=ref,
-                        position=ref,
-                        status="OK",
-                        update=update_status,
-                    )
-                )
-                continue
+            return dict(
+                folder=folder_path.name,
+                ref=ref,
+                position=ref,
+                status="OK",
+                update="New",
+            )
 
-            # All else is either behind or ahead. Find out.
-            commit_delta = self.get_commits_behind_or_ahead(repo, ref)
-            if commit_delta:
-                if commit_delta < 0:
-                    status = f"{commit_delta} behind"
-                else:
-                    status = f"{commit_delta} ahead"
+        # Repo is valid.
+        set_sparse(repo, record.get("sparse"))
+        # Check that the ref exists here first
+        self.get_shallow_ref(repo, record)
+        if not ref_in_refs(repo, ref):
+            return dict(
+                folder=folder_path.name,
+                ref=ref,
+                position="invalid",
+                status="invalid",
+                update="N/A",
+            )
 
-                tabler.push_datum(
-                    dict(
-                        folder=folder_path.name,
-                        ref=ref,
-                        position=repo.commit().hexsha[:8],
-                        status=status,
-                        update=update_status,
-                    )
-                )
-                continue
+        with span("pull" if self.fetch else "fast-forward", "phase", repo=repo_name):
+            if self.fetch:
+                update_status = git_pull_change(repo, ref)
+            else:
+                update_status = git_fast_forward(repo, ref)
+        if update_status == "invalid":
+            return dict(
+                folder=folder_path.name,
+                ref=ref,
+                position=ref,
+                status="invalid",
+                update=update_status,
+            )
 
-            if repo.is_dirty():
-                ref_type = get_repo_ref_type(repo, ref)
-                tabler.push_datum(
-                    dict(
-                        folder=folder_path.name,
-                        ref=ref,
-                        ref_type=ref_type.name,
-                        status="Dirty",
-                        update=update_status,
-                    )
-                )
+        # If a Git repo is in good status, check for changes
+        state = get_repo_state(repo, ref)
+        if state.ok:
+            return dict(
+                folder=folder_path.name,
+                ref=ref,
+                position=ref,
+                status="OK",
+                update=update_status,
+            )
+
+        # All else is either behind or ahead. Find out.
+        if state.behind or state.ahead:
+            return dict(
+                folder=folder_path.name,
+                ref=ref,
+                position=state.head_sha[:8],
+                status=self.format_commit_delta(state),
+                update=update_status,
+            )
+
+        if state.dirty:
+            return dict(
+                folder=folder_path.name,
+                ref=ref,
+                ref_type=state.ref_type.name,
+                status="Dirty",
+                update=update_status,
+            )
 
-        print(tabler.get_table())
+        return None
+
+    @staticmethod
+    def get_shallow_ref(repo, record):
+        """Fetch the ref of record into repo, if repo is shallow and lacks it"""
+        ref = record.get("ref")
+        if is_shallow(repo) and not ref_in_refs(repo, ref):
+            LOG.info("Fetching %s into shallow repo %s", ref, repo.working_dir)
+            fetch_ref(repo, ref, record.get("depth"))
+
+    def map_repos(self, func, repos, on_error=None, on_result=None):
+        """Run func(repo_name, record) for every manifest repo.
+
+        * Up to self.jobs repos are handled at the same time on a thread pool, or all
+          of them when self.jobs is 0.
+        * A repo that raises does not cancel the others: on_error(repo_name, record,
+          exception) provides its result instead (None if on_error is not given).
+        * on_result(repo_name, result) is called as soon as each repo finishes.
+        * On KeyboardInterrupt, the repos not started yet are skipped, and the
+          commands of the running ones are stopped.
+        * The seconds each repo took are kept in self.elapsed, and each repo is a
+          span of the profile, if any.
+
+        Return: list of results, in manifest order.
+        """
+        items = list(repos.items())
+        results = [None] * len(items)
+        phase = getattr(func, "__name__", "repo")
+
+        def _call(item):
+            repo_name, record = item
+            start = time.perf_counter()
+            try:
+                with span(repo_name, "repo", phase=phase):
+                    return func(repo_name, record)
+            except Exception as ex:
+                LOG.critical("Repo %s failed: %s", repo_name, ex)
+                LOG.debug("Full repo error:", exc_info=True)
+                return on_error(repo_name, record, ex) if on_error else None
+            finally:
+                self.elapsed[repo_name] = time.perf_counter() - start
+
+        def _done(index, result):
+            results[index] = result
+            if on_result:
+                on_result(items[index][0], result)
+
+        workers = self.jobs or len(items)
+        if workers <= 1 or len(items) <= 1:
+            for index, item in enumerate(items):
+                _done(index, _call(item))
+            return results
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(_call, item): index for index, item in enumerate(items)
+            }
+            try:
+                for future in as_completed(futures):
+                    _done(futures[future], future.result())
+            except KeyboardInterrupt:
+                # Start no other repo, and stop the commands of the running ones.
+                for future in futures:
+                    future.cancel()
+                LOG.critical("Interrupted, stopped %s commands", cancel_all())
+                raise
+        return results
+
+    def timed(self, repo_name, datum):
+        """Add the seconds repo_name took to a copy of datum, with self.timings"""
+        if not self.timings or not datum:
+            return datum
+        seconds = self.elapsed.get(repo_name)
+        return dict(datum, seconds="N/A" if seconds is None else f"{seconds:.2f}")
+
+    def get_stream(self, repos):
+        """Get a Tabler to stream rows as repos finish.
+
+        * None unless self.stream, or the output format is "ndjson".
+        * Column widths start from the folder names and refs of the manifest, and
+          grow to fit the rows that come in.
+        """
+        if not self.stream and self.output_format != "ndjson":
+            return None
+        refs = [str(record.get("ref")) for record in repos.values()]
+        widths = dict(
+            folder=max((len(name) for name in repos), default=0),
+            ref=max((len(ref) for ref in refs), default=0),
+        )
+        return Tabler(widths=widths)
+
+    def get_stream_target(self):
+        """Get the file and format of the streamed rows.
+
+        * Table and NDJSON rows go to self.output in the output format.
+        * With the other formats, streamed rows only show progress: they go to
+          stderr as table rows, so stdout holds the final results alone.
+
+        Return: (file, format)
+        """
+        if self.output_format in ("table", "ndjson"):
+            return self.output, self.output_format
+        return sys.stderr, "table"
+
+    def stream_datum(self, stream, datum):
+        """Print datum right away, if there is a stream"""
+        if stream and datum:
+            file, fmt = self.get_stream_target()
+            stream.stream_datum(datum, file=file, fmt=fmt)
+
+    def end_stream(self, stream):
+        """Close a streamed table, the final table of all rows comes next"""
+        if not stream:
+            return
+        file, fmt = self.get_stream_target()
+        if fmt == "table":
+            stream.stream_end(file=file)
+        if self.output_format == "table":
+            print("Summary:", file=self.output)
+
+    def print_table(self, tabler, stream=None):
+        """Print the final tabler in the output format.
+
+        * NDJSON rows were already printed by the stream as they came in.
+        """
+        if stream and self.output_format == "ndjson":
+            return
+        end = "\n" if self.output_format == "table" else ""
+        print(tabler.render(self.output_format), end=end, file=self.output)
 
     def get_repos_from_manifest(self):
         """Get repos and refs for each manifest repo"""
@@ -390,10 +744,7 @@ class Manifest:
     @staticmethod
     def get_current_tag(repo):
         """Get the current tag if it exists, else None"""
-        tag = next(
-            (tag.name for tag in repo.tags if tag.commit == repo.head.commit), None
-        )
-        return tag
+        return get_tag_name(repo)
 
     @staticmethod
     def get_valid_repo(folder_name):
@@ -419,89 +770,255 @@ class Manifest:
 
         Return: (int) Total error
         """
-        total_error = 0
-        error = 0
-        tabler = Tabler()
-        repos = self.get_repos_from_manifest()
         make_cmd = ["make", "install"]
         pip_cmd = ["python3", "-m", "pip", "install", "."]
+        return self.run_builds(make_cmd, pip_cmd, "build")
 
-        for _folder, _record in repos.items():
-            folder_path = self.get_folder_path(_folder)
-            make_path = folder_path / "Makefile"
-
-            if make_path.exists():
-                error = folder_cmd(folder_path, make_cmd)
-                state = "Failed" if error else "OK"
+    def build_repos_dev(self, selected=None, report=True):
+        """Build all repos, or the repo names in selected, in development mode.
 
-            elif _record.get("type") == "python":
-                error = folder_cmd(folder_path, pip_cmd)
-                state = "Failed" if error else "OK"
-
-            else:
-                error = 10
-                state = f"Builder {_folder} N/A"
+        Return: (int) Total error
+        """
+        make_cmd = ["make", "dev"]
+        pip_cmd = ["python3", "-m", "pip", "install", "-e", ".[dev]"]
+        return self.run_builds(
+            make_cmd, pip_cmd, "build_dev", selected=selected, report=report
+        )
 
-            total_error += error
-            tabler.push_datum(dict(folder=_folder, build=state))
+    def run_builds(self, make_cmd, pip_cmd, column, selected=None, report=True):
+        """Build all repos with make_cmd, or pip_cmd for python repos without Makefile.
 
-        print(tabler.get_table())
-        return total_error
+        * If selected is given, only the repo names in it are built, the others are
+          "Skipped".
+        * Unless report, the results are logged as a table instead of being printed
+          in the output format.
 
-    def build_repos_dev(self):
-        """Build all repos in development mode.
+        * Repos are built level by level of the dependency graph, so every repo is
+          built once and after the repos it depends on.
+        * Repos of the same level are built on a pool of self.jobs workers.
+        * Repos whose tree, command and dependencies match their last successful
+          build are skipped, unless self.use_cache is False.
+        * Repos that depend on a failed repo are not built, they are "Blocked".
+        * Repos in a dependency cycle are not built either.
+        * The state of each repo is reported in the Tabler column named column.
 
         Return: (int) Total error
         """
         total_error = 0
-        error = 0
         tabler = Tabler()
         repos = self.get_repos_from_manifest()
-        make_cmd = ["make", "dev"]
-        pip_cmd = ["python3", "-m", "pip", "install", "-e", ".[dev]"]
+        dependencies = get_dependencies(self, repos)
+        levels, cyclic = get_build_levels(dependencies)
+        results = {name: (10, "Cycle") for name in cyclic}
+        build_cache = BuildCache(self)
+        build_keys = {}
+
+        def build(repo_name, record):
+            failed = [name for name in dependencies[repo_name] if results[name][0]]
+            if failed:
+                LOG.warning("Not building %s, it depends on: %s", repo_name, failed)
+                return 1, "Blocked"
+
+            key = self.get_build_key(
+                repo_name, [make_cmd, pip_cmd], dependencies, build_keys
+            )
+            build_keys[repo_name] = key
+            if selected is not None and repo_name not in selected:
+                return 0, "Skipped"
+            if self.use_cache and build_cache.is_fresh(repo_name, key):
+                LOG.info("Build of %s is up to date", repo_name)
+                return 0, "Cached"
+
+            error, state = self.build_repo(repo_name, record, make_cmd, pip_cmd)
+            build_cache.record(repo_name, key, not error)
+            return error, state
+
+        def on_error(_repo_name, _record, _ex):
+            return 100, "Failed"
+
+        stream = self.get_stream(repos) if report else None
+
+        def on_result(repo_name, result):
+            datum = {"folder": repo_name, column: result[1]}
+            self.stream_datum(stream, self.timed(repo_name, datum))
+
+        for level in levels:
+            level_repos = {name: repos[name] for name in level}
+            level_results = self.map_repos(
+                build, level_repos, on_error=on_error, on_result=on_result
+            )
+            results.update(zip(level, level_results))
+        self.end_stream(stream)
 
-        for _folder, _record in repos.items():
-            folder_path = self.get_folder_path(_folder)
-            make_path = folder_path / "Makefile"
+        for _folder in repos:
+            error, state = results[_folder]
+            total_error += error
+            tabler.push_datum(self.timed(_folder, {"folder": _folder, column: state}))
 
-            if make_path.exists():
-                error = folder_cmd(folder_path, make_cmd)
-                state = "Failed" if error else "OK"
+        build_cache.save()
+        if report:
+            self.print_table(tabler, stream)
+        else:
+            LOG.info("Builds:\n%s", tabler.get_table())
+        if self.use_cache:
+            print(build_cache.summary())
+        return total_error
 
-            elif _record.get("type") == "python":
-                error = folder_cmd(folder_path, pip_cmd)
-                state = "Failed" if error else "OK"
+    def get_build_key(self, repo_name, command, dependencies, build_keys):
+        """Get the build cache key of repo_name, None if it can't be fingerprinted"""
+        repo = self.get_valid_repo(self.get_folder_path(repo_name))
+        if not repo:
+            return None
+        try:
+            fingerprint = get_tree_fingerprint(repo)
+        except (ValueError, GitCommandError) as ex:
+            LOG.debug("Can't fingerprint %s: %s", repo_name, ex)
+            return None
+        dependency_keys = [build_keys.get(name) for name in dependencies[repo_name]]
+        if None in dependency_keys:
+            return None
+        return BuildCache.make_build_key(fingerprint, command, dependency_keys)
+
+    def build_repo(self, repo_name, record, make_cmd, pip_cmd):
+        """Build a single manifest repo.
+
+        Return: (int error, str state)
+        """
+        folder_path = self.get_folder_path(repo_name)
+        make_path = folder_path / "Makefile"
 
-            else:
-                error = 10
-                state = f"Builder {_folder} N/A"
+        if make_path.exists():
+            error = folder_cmd(folder_path, make_cmd, timeout=self.timeout)
+            state = "Failed" if error else "OK"
 
-            total_error += error
-            tabler.push_datum(dict(folder=_folder, build_dev=state))
+        elif record.get("type") == "python":
+            error = folder_cmd(folder_path, pip_cmd, timeout=self.timeout)
+            state = "Failed" if error else "OK"
 
-        print(tabler.get_table())
-        return total_error
+        else:
+            error = 10
+            state = f"Builder {repo_name} N/A"
+
+        return error, state
 
     def test_repos(self):
         """Test all repos
 
+        * Repos are tested on a pool of self.jobs workers.
+        * Green results are remembered in .morq/test-state.json, per repo tree
+          fingerprint and the fingerprints of the repos it depends on.
+        * With self.affected, only the repos changed since their last green test, or
+          depending on such a repo, are built and tested. The others are "Cached".
+
         Return: Total error
         """
         total_error = 0
-        total_error += self.build_repos_dev()
-        tabler = Tabler()
         repos = self.get_repos_from_manifest()
+        dependencies = get_dependencies(self, repos)
+        test_cache = StateFile(self, "test-state.json")
+        affected, fingerprints = self.get_affected_repos(
+            repos, dependencies, test_cache
+        )
+        selected = affected if self.affected else set(repos)
+        if not selected:
+            LOG.info("No repo is affected since the last green test run")
+        else:
+            # Only the test results are reported in machine readable formats.
+            total_error += self.build_repos_dev(
+                selected=selected, report=self.output_format == "table"
+            )
+        tabler = Tabler()
 
-        for _folder, _ in repos.items():
-            error = 0
-            folder_path = self.get_folder_path(_folder)
-            error += folder_cmd(folder_path, ["make", "test"], stdout=True)
-            total_error += error
-            tabler.push_datum(dict(folder=_folder, test=("Failed" if error else "OK")))
+        def test(repo_name, _record):
+            if repo_name not in selected:
+                return None
+            folder_path = self.get_folder_path(repo_name)
+            error = folder_cmd(
+                folder_path, ["make", "test"], stdout=True, timeout=self.timeout
+            )
+            repo = self.get_valid_repo(folder_path)
+            if error or not repo:
+                test_cache.pop(repo_name)
+                return error
+            fingerprints[repo_name] = get_tree_fingerprint(repo)
+            return error
 
-        print(tabler.get_table())
+        def get_state(error):
+            if error is None:
+                return "Cached"
+            return "Failed" if error else "OK"
+
+        stream = self.get_stream(repos)
+
+        def on_result(repo_name, error):
+            datum = dict(folder=repo_name, test=get_state(error))
+            self.stream_datum(stream, self.timed(repo_name, datum))
+
+        results = self.map_repos(
+            test, repos, on_error=lambda *_: 100, on_result=on_result
+        )
+        self.end_stream(stream)
+        for _folder, error in zip(repos, results):
+            total_error += error or 0
+            datum = dict(folder=_folder, test=get_state(error))
+            tabler.push_datum(self.timed(_folder, datum))
+
+        for _folder, error in zip(repos, results):
+            if error == 0:
+                test_cache.set(
+                    _folder,
+                    dict(
+                        fingerprint=fingerprints[_folder],
+                        dependencies={
+                            name: fingerprints.get(name)
+                            for name in dependencies[_folder]
+                        },
+                    ),
+                )
+        test_cache.save()
+
+        self.print_table(tabler, stream)
         return total_error
 
+    def get_affected_repos(self, repos, dependencies, test_cache):
+        """Find the repos that changed since their last green test.
+
+        * A repo is affected if it has no green test, if git reports a change of its
+          tree since that test, or if a repo it depends on is affected or changed.
+        * Every repo is affected if self.use_cache is False.
+
+        Return: (set of affected repo names, dict of repo_name: tree fingerprint)
+        """
+        levels, cyclic = get_build_levels(dependencies)
+        affected = set(cyclic)
+        fingerprints = {}
+
+        for repo_name in [name for level in levels for name in level] + cyclic:
+            repo = self.get_valid_repo(self.get_folder_path(repo_name))
+            fingerprint = None
+            if repo:
+                try:
+                    fingerprint = get_tree_fingerprint(repo)
+                except (ValueError, GitCommandError) as ex:
+                    LOG.debug("Can't fingerprint %s: %s", repo_name, ex)
+            fingerprints[repo_name] = fingerprint
+
+            record = test_cache.get(repo_name) or {}
+            upstream = {
+                name: fingerprints.get(name) for name in dependencies[repo_name]
+            }
+            if (
+                not self.use_cache
+                or fingerprint is None
+                or any(name in affected for name in upstream)
+                or record.get("dependencies") != upstream
+                or tree_changed_since(repo, record.get("fingerprint"), fingerprint)
+            ):
+                affected.add(repo_name)
+
+        LOG.info("Affected repos: %s", ", ".join(sorted(affected)) or "None")
+        return affected, fingerprints
+
     def list_repos(self):
         """List repos and refs for each manifest repo"""
         repos = self.get_repos_from_manifest()
@@ -509,7 +1026,7 @@ class Manifest:
 
         for _, record in repos.items():
             tabler.push_datum(dict(url=record.get("url"), ref=record.get("ref")))
-        print(tabler.get_table())
+        self.print_table(tabler)
 
     def init_sphinx(self):
         """Initialize and setup Sphinx for the manifest path"""
@@ -0,0 +1,152 @@
+"""Time git calls, subprocesses and repo phases, and write Chrome traces of them"""
+import contextlib
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+
+import git
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger("orquestra_manifest.profiler")
+
+# Number of slowest steps logged at the end of a profile.
+TOP_STEPS = 10
+
+_PROFILER = None
+
+
+class Profiler:
+    """Record timed spans from any thread.
+
+    * Spans are kept as Chrome trace "complete" events, with times in microseconds
+      since the profiler started.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.events = []
+        self.threads = {}
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        """Time the block as a span named name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, category, start, time.perf_counter(), args)
+
+    def record(self, name, category, start, end, args=None):
+        """Record a span that ran from start to end, perf_counter() times"""
+        thread = threading.current_thread()
+        event = dict(
+            name=name,
+            cat=category,
+            ph="X",
+            ts=round((start - self.start) * 1e6, 1),
+            dur=round((end - start) * 1e6, 1),
+            pid=os.getpid(),
+            tid=thread.ident,
+            args={key: str(value) for key, value in (args or {}).items()},
+        )
+        with self.lock:
+            self.events.append(event)
+            self.threads.setdefault(thread.ident, thread.name)
+
+    def to_chrome_trace(self):
+        """Get the spans as a Chrome trace dict, for chrome://tracing or Perfetto"""
+        with self.lock:
+            events = list(self.events)
+            threads = dict(self.threads)
+        metadata = [
+            dict(
+                name="thread_name",
+                ph="M",
+                pid=os.getpid(),
+                tid=ident,
+                args=dict(name=name),
+            )
+            for ident, name in threads.items()
+        ]
+        return dict(traceEvents=metadata + events, displayTimeUnit="ms")
+
+    def write(self, path):
+        """Write the Chrome trace to path"""
+        path = pathlib.Path(path)
+        path.write_text(json.dumps(self.to_chrome_trace()), encoding="utf-8")
+
+    def get_totals(self):
+        """Get the total seconds of each (category, name), slowest first"""
+        totals = {}
+        with self.lock:
+            for event in self.events:
+                key = (event["cat"], event["name"])
+                totals[key] = totals.get(key, 0.0) + event["dur"] / 1e6
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+
+def get_profiler():
+    """Get the active Profiler, None when not profiling"""
+    return _PROFILER
+
+
+@contextlib.contextmanager
+def span(name, category, **args):
+    """Time the block with the active Profiler, if any"""
+    profiler = _PROFILER
+    if profiler is None:
+        yield
+        return
+    with profiler.span(name, category, **args):
+        yield
+
+
+def _git_execute(execute):
+    """Wrap GitPython's Git.execute, to time every git command.
+
+    * Commands run as_process, as clone, pull and fetch of GitPython are, return
+      before git exits: they are not timed here, but where they are called.
+    """
+
+    def profiled_execute(self, command, *args, **kwargs):
+        if kwargs.get("as_process"):
+            return execute(self, command, *args, **kwargs)
+        if not isinstance(command, (list, tuple)):
+            command = str(command).split()
+        name = " ".join(str(part) for part in command[:2])
+        folder = pathlib.Path(str(self._working_dir or os.getcwd())).name
+        with span(name, "git", repo=folder, command=command):
+            return execute(self, command, *args, **kwargs)
+
+    return profiled_execute
+
+
+@contextlib.contextmanager
+def profiling(path=None):
+    """Profile the block: git commands, and the spans of span().
+
+    * The Chrome trace is written to path, if given, and the slowest steps are
+      logged.
+
+    yields: the active Profiler
+    """
+    global _PROFILER  # pylint: disable=global-statement
+    profiler = Profiler()
+    execute = git.cmd.Git.execute
+    _PROFILER = profiler
+    git.cmd.Git.execute = _git_execute(execute)
+    try:
+        with profiler.span("morq", "command"):
+            yield profiler
+    finally:
+        git.cmd.Git.execute = execute
+        _PROFILER = None
+        if path:
+            profiler.write(path)
+            LOG.info("Profile written to %s", path)
+        for (category, name), seconds in profiler.get_totals()[:TOP_STEPS]:
+            LOG.info("%8.3fs  %-10s %s", seconds, category, name)
@@ -0,0 +1,140 @@
+"""Network side of repo updates: fetch remotes, a few repos per host at a time"""
+import contextlib
+import getpass
+import logging
+import os
+import re
+import tempfile
+import threading
+from stat import S_ISDIR
+from urllib.parse import urlsplit
+
+from orquestra_manifest.profiler import span
+from orquestra_manifest.utils import get_ref_index, invalidate_ref_index, is_shallow
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger("orquestra_manifest.remote")
+
+# Default number of repos fetched from the same host at the same time.
+PER_HOST = 4
+# Seconds an idle shared SSH connection is kept open.
+CONTROL_PERSIST = 60
+
+# scp-like URLs: [user@]host:path
+SCP_RX = re.compile(r"^(?:[^@/]+@)?(?P<host>[^:/]+):(?!//)")
+
+
+def get_remote_host(url):
+    """Get the host of a git remote url, "local" for paths and file:// urls"""
+    url = str(url or "")
+    if "://" in url:
+        parts = urlsplit(url)
+        return parts.hostname or "local"
+    match = SCP_RX.match(url)
+    if match:
+        return match.group("host")
+    return "local"
+
+
+def get_control_dir():
+    """Get the default folder of the SSH ControlMaster sockets.
+
+    * $XDG_RUNTIME_DIR/morq-ssh if set, else a morq-ssh-<user> folder of the
+      temporary folder.
+    """
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "morq-ssh")
+    return os.path.join(tempfile.gettempdir(), f"morq-ssh-{getpass.getuser()}")
+
+
+def is_private_dir(path):
+    """Is path a real folder, owned by the current user and closed to others?"""
+    try:
+        stat = os.lstat(path)
+    except OSError:
+        return False
+    return (
+        S_ISDIR(stat.st_mode)
+        and stat.st_uid == os.getuid()
+        and not stat.st_mode & 0o077
+    )
+
+
+def get_ssh_command(control_dir=None):
+    """Get a GIT_SSH_COMMAND sharing one SSH connection per host.
+
+    * Uses the SSH ControlMaster of control_dir, get_control_dir() by default. Its
+      sockets are named after a hash of the connection.
+    * control_dir must be a folder of the current user that others can't access,
+      else another user could plant a socket in it. Connections are not shared if
+      it is not.
+    * A GIT_SSH_COMMAND of the environment is left alone.
+    * Connections are not shared on Windows, its SSH has no ControlMaster.
+    """
+    if os.environ.get("GIT_SSH_COMMAND"):
+        return os.environ["GIT_SSH_COMMAND"]
+    if not hasattr(os, "getuid"):
+        return "ssh"
+
+    if control_dir is None:
+        control_dir = get_control_dir()
+    with contextlib.suppress(FileExistsError):
+        os.makedirs(control_dir, mode=0o700)
+    if not is_private_dir(control_dir):
+        LOG.warning("Not sharing SSH connections, %s is not private", control_dir)
+        return "ssh"
+    return (
+        "ssh -o ControlMaster=auto"
+        f" -o ControlPath={os.path.join(control_dir, '%C')}"
+        f" -o ControlPersist={CONTROL_PERSIST}"
+    )
+
+
+class HostLimiter:
+    """Limit the number of repos handled at the same time for each host.
+
+    * limit(host) is a context manager, waiting for one of the per_host slots of
+      host. It is safe to use from several threads.
+    """
+
+    def __init__(self, per_host=PER_HOST):
+        self.per_host = max(1, per_host)
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    @contextlib.contextmanager
+    def limit(self, host):
+        """Hold a slot of host for the duration of the block.
+
+        * The wait for the slot is a span of the profile, if any.
+        """
+        with self.lock:
+            semaphore = self.semaphores.setdefault(
+                host, threading.BoundedSemaphore(self.per_host)
+            )
+        with span(host, "wait"):
+            semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+
+def fetch_repo(repo, env=None):
+    """Fetch the branches and tags of origin, without touching the work tree.
+
+    * Shallow repos only get the tags of the commits they fetch, other tags would
+      bring their whole history.
+
+    return: state string: [changed, unchanged]
+    """
+    before = dict(get_ref_index(repo).shas)
+    options = [] if is_shallow(repo) else ["--tags"]
+    try:
+        repo.git.fetch(*options, "origin", env=env)
+    finally:
+        invalidate_ref_index(repo)
+
+    if get_ref_index(repo).shas != before:
+        return "changed"
+    return "unchanged"
@@ -0,0 +1,194 @@
+"""Run subprocesses with asyncio, and stream their output line by line"""
+import asyncio
+import contextlib
+import logging
+import os
+import signal
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from orquestra_manifest.profiler import span
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger("orquestra_manifest.runner")
+
+# Longest piece of a line held in memory, longer lines come in pieces.
+LINE_LIMIT = 64 * 1024
+# Last lines of output kept for each process.
+TAIL_LINES = 100
+# Seconds a process gets to exit after being terminated, before being killed.
+KILL_GRACE = 5
+# Return code of a process that timed out, as with timeout(1).
+TIMEOUT_ERROR = 124
+# Return code of a command that could not be started, as with sh(1).
+START_ERROR = 126
+# Processes run in a session of their own, so their whole group can be stopped.
+PROCESS_GROUPS = hasattr(os, "killpg")
+
+_RUNNING = {}
+_RUNNING_LOCK = threading.Lock()
+
+
+@dataclass
+class ProcessResult:
+    """Outcome of a process
+
+    * tail: its last TAIL_LINES lines, as (stream name, line) tuples.
+    """
+
+    returncode: int
+    tail: list = field(default_factory=list)
+    timed_out: bool = False
+
+
+@contextlib.contextmanager
+def _running(proc):
+    """Register proc, so cancel_all() can reach it"""
+    with _RUNNING_LOCK:
+        _RUNNING[proc] = asyncio.get_running_loop()
+    try:
+        yield
+    finally:
+        with _RUNNING_LOCK:
+            _RUNNING.pop(proc, None)
+
+
+def cancel_all():
+    """Kill every running process, from any thread.
+
+    return: number of processes killed
+    """
+    with _RUNNING_LOCK:
+        running = list(_RUNNING.items())
+    for proc, loop in running:
+        with contextlib.suppress(RuntimeError):
+            loop.call_soon_threadsafe(_kill, proc)
+    return len(running)
+
+
+def _signal(proc, signum):
+    """Send signum to the process group of proc, to proc alone without groups"""
+    with contextlib.suppress(ProcessLookupError, PermissionError):
+        if PROCESS_GROUPS:
+            os.killpg(proc.pid, signum)
+        elif signum == signal.SIGTERM:
+            proc.terminate()
+        else:
+            proc.kill()
+
+
+def _kill(proc):
+    """Kill proc and the processes it started, unless they are already gone"""
+    _signal(proc, getattr(signal, "SIGKILL", signal.SIGTERM))
+
+
+async def _stop(proc):
+    """Terminate proc and the processes it started.
+
+    * proc is killed if it does not exit within KILL_GRACE, and the processes it
+      started are killed once it exited.
+    * What is left in the pipes is read, so no process holds them when the event
+      loop closes.
+    """
+    _signal(proc, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(proc.wait(), KILL_GRACE)
+    except asyncio.TimeoutError:
+        pass
+    _kill(proc)
+    await proc.wait()
+    with contextlib.suppress(asyncio.TimeoutError):
+        await asyncio.wait_for(
+            asyncio.gather(proc.stdout.read(), proc.stderr.read()), KILL_GRACE
+        )
+
+
+async def _pump(stream, name, on_line, tail):
+    """Read stream line by line, until EOF"""
+    while True:
+        try:
+            data = await stream.readuntil(b"\n")
+        except asyncio.IncompleteReadError as ex:
+            data = ex.partial
+            if not data:
+                return
+        except asyncio.LimitOverrunError as ex:
+            data = await stream.read(min(ex.consumed, LINE_LIMIT))
+        line = data.decode(errors="replace").rstrip("\r\n")
+        tail.append((name, line))
+        if on_line:
+            on_line(name, line)
+
+
+async def run_process(command, cwd=None, on_line=None, timeout=None):
+    """Run command, and hand each line of its output to on_line as it comes.
+
+    * on_line(stream name, line) is called with "stdout" or "stderr" lines.
+    * At most LINE_LIMIT bytes of a line, and TAIL_LINES lines, are held in memory.
+    * A process still running after timeout seconds is stopped, with the processes
+      it started. Cancelling the coroutine stops them too.
+
+    Return: ProcessResult
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *command,
+        cwd=cwd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=LINE_LIMIT,
+        start_new_session=PROCESS_GROUPS,
+    )
+    tail = deque(maxlen=TAIL_LINES)
+    with _running(proc):
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(
+                    _pump(proc.stdout, "stdout", on_line, tail),
+                    _pump(proc.stderr, "stderr", on_line, tail),
+                    proc.wait(),
+                ),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            LOG.warning("Stopping %s after %s seconds", " ".join(command), timeout)
+            await _stop(proc)
+            return ProcessResult(TIMEOUT_ERROR, list(tail), timed_out=True)
+        except asyncio.CancelledError:
+            await _stop(proc)
+            raise
+    return ProcessResult(proc.returncode, list(tail))
+
+
+def _has_running_loop():
+    """Is an event loop running in this thread?"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def run(command, cwd=None, on_line=None, timeout=None):
+    """Run command to completion on its own event loop, see run_process().
+
+    * Safe to call from several threads at once.
+    * Safe to call while an event loop runs in this thread, as in a notebook: the
+      process then runs on a private loop in a worker thread, and this call blocks.
+    * The process is a span of the profile, if any.
+    """
+    with span(" ".join(command), "subprocess", cwd=cwd):
+        if not _has_running_loop():
+            return asyncio.run(run_process(command, cwd, on_line, timeout))
+        with ThreadPoolExecutor(1, thread_name_prefix="morq-runner") as executor:
+            future = executor.submit(
+                asyncio.run, run_process(command, cwd, on_line, timeout)
+            )
+            try:
+                return future.result()
+            except KeyboardInterrupt:
+                # The process is in a session of its own, out of reach of Ctrl-C.
+                cancel_all()
+                raise
@@ -1,11 +1,40 @@
 """Module to assist with text tables"""
+import csv
+import io
+import json
 import logging
 import re
+import sys
+import threading
+
 from clint.textui import colored
 
 logging.basicConfig()
 LOG = logging.getLogger("tabler")
 
+# Output formats of tables.
+FORMATS = ("table", "json", "ndjson", "csv")
+
+# Known state words, and their color in tables.
+COLORS = {
+    "Missing": "red",
+    "None": "red",
+    "Invalid": "red",
+    "N/A": "red",
+    "Updated": "blue",
+    "OK": "green",
+    "changed": "yellow",
+    "unchanged": "green",
+    "New": "blue",
+}
+# Known state words surrounded by whitespace.
+COLOR_RX = re.compile(r"(?<=\s)(" + "|".join(map(re.escape, COLORS)) + r")(?=\s)")
+
+
+def get_colored_words():
+    """Get the dict of known state word: colored word"""
+    return {word: str(getattr(colored, color)(word)) for word, color in COLORS.items()}
+
 
 class Tabler:
     """Tabler makes tables from list(dict) of data.
@@ -31,15 +60,18 @@ class Tabler:
     ]
     """
 
-    def __init__(self):
+    def __init__(self, widths=None):
+        """widths: optional dict of field: minimum column width"""
         self.data = []
+        self.widths = dict(widths or {})
+        self.lock = threading.Lock()
 
     def get_headings(self):
         """Get headings of data"""
         return list(self.data[0].keys())
 
     def push_datum(self, element):
-        """Push a dict onto on self.data"""
+        """Push a dict onto on self.data, and widen the columns to fit it"""
         if element.__class__ is not dict:
             raise ValueError("You must push a dict object")
 
@@ -47,38 +79,39 @@ class Tabler:
         if self.data:
             if not set(self.data[0]).intersection(element):
                 raise ValueError("You can't push dicts with different keys")
+            headings = self.data[0]
+        else:
+            headings = element
+            for field in headings:
+                self.widths[field] = max(self.widths.get(field, 0), len(field))
 
         self.data.append(element)
+        widths = self.widths
+        for field in headings:
+            length = len(str(element.get(field, "")))
+            if length > widths[field]:
+                widths[field] = length
 
     def get_dimensions(self):
         """Get the dimension of data entries, based on first data[0]"""
-        dimension = []
-        for field in self.data[0]:
-            # Use the heading and the data entries to calculate size.
-            strings = list([field])
-            strings.extend([x.get(field) for x in self.data])
-            length = len(max(strings, key=len))
-            dimension.append(length)
-        return dimension
-
-    def liner(self):
+        return [self.widths[field] for field in self.data[0]]
+
+    def liner(self, dims=None):
         """Make a seperator line"""
-        dims = self.get_dimensions()
-        liner = "+"
-        for dim in dims:
-            liner += f'-{"-" *  dim }-+'
-        liner += "\n"
-        return liner
+        dims = dims or self.get_dimensions()
+        return "+" + "".join(f"-{'-' * dim}-+" for dim in dims) + "\n"
 
-    def header(self):
+    def header(self, dims=None):
         """Make a header line"""
-        dims = self.get_dimensions()
+        dims = dims or self.get_dimensions()
         headings = self.get_headings()
-        header = "|"
-        for idx, head in enumerate(headings):
-            header += f" {head:{dims[idx]}s} |"
-        header += "\n"
-        return header
+        return self.make_line(headings, dims)
+
+    @staticmethod
+    def make_line(cells, dims):
+        """Make a table line out of cells padded to dims"""
+        padded = [f"{cell:{dim}s}" for cell, dim in zip(cells, dims)]
+        return "| " + " | ".join(padded) + " |\n"
 
     def color_word(self, color, word, output):
         """Make a word red in output"""
@@ -88,36 +121,102 @@ class Tabler:
         new = re.sub(regex, new_word, output)
         return new
 
+    def color_words(self, output, colors=None):
+        """Color the known state words of output, in a single pass"""
+        colors = colors or get_colored_words()
+        return COLOR_RX.sub(lambda match: colors[match.group(0)], output)
+
+    def data_line(self, datum, dims, colors=None):
+        """Make the line of a single datum, with its known state words colored"""
+        cells = [str(datum.get(field, "")) for field in self.get_headings()]
+        return self.color_words(self.make_line(cells, dims), colors)
+
     def data_lines(self):
         """Return the data in lines"""
         dims = self.get_dimensions()
+        colors = get_colored_words()
+        return "".join(self.data_line(_datum, dims, colors) for _datum in self.data)
+
+    def get_rows(self):
+        """Get the data as a list of dicts holding the headings of data[0] only"""
+        if not self.data:
+            return []
         headings = self.get_headings()
-        output = str()
-
-        for _datum in self.data:
-            data_line = "|"
-            for idx, _ in enumerate(headings):
-                data_line += f" {_datum.get(headings[idx]):{dims[idx]}s} |"
-            data_line += "\n"
-            output += data_line
-
-        output = self.color_word("red", "Missing", output)
-        output = self.color_word("red", "None", output)
-        output = self.color_word("red", "Invalid", output)
-        output = self.color_word("red", "N/A", output)
-        output = self.color_word("blue", "Updated", output)
-        output = self.color_word("green", "OK", output)
-        output = self.color_word("yellow", "changed", output)
-        output = self.color_word("green", "unchanged", output)
-        output = self.color_word("blue", "New", output)
-
-        return output
+        return [{field: datum.get(field) for field in headings} for datum in self.data]
+
+    def to_json(self):
+        """Get the data as a JSON list of objects"""
+        return json.dumps(self.get_rows(), indent=2)
+
+    @staticmethod
+    def ndjson_line(row):
+        """Get a row as one line of newline delimited JSON"""
+        return json.dumps(row) + "\n"
+
+    def to_ndjson(self):
+        """Get the data as newline delimited JSON, one object per line"""
+        return "".join(self.ndjson_line(row) for row in self.get_rows())
+
+    def to_csv(self):
+        """Get the data as CSV, with a header line"""
+        if not self.data:
+            return ""
+        output = io.StringIO()
+        writer = csv.DictWriter(
+            output,
+            fieldnames=self.get_headings(),
+            extrasaction="ignore",
+            lineterminator="\n",
+        )
+        writer.writeheader()
+        writer.writerows(self.get_rows())
+        return output.getvalue()
+
+    def render(self, fmt="table"):
+        """Get the data in one of FORMATS"""
+        if fmt == "table":
+            return self.get_table()
+        if fmt == "json":
+            return self.to_json() + "\n"
+        if fmt == "ndjson":
+            return self.to_ndjson()
+        if fmt == "csv":
+            return self.to_csv()
+        raise ValueError(f"Unknown table format: {fmt}")
+
+    def stream_datum(self, element, file=None, fmt="table"):
+        """Push element, and print it as a table row right away.
+
+        * The header is printed with the first row.
+        * Column widths start from self.widths and grow to fit new rows. Rows that
+          were already printed are not realigned.
+        * With fmt "ndjson", the row is printed as a line of JSON instead.
+        * Safe to call from several threads.
+        """
+        with self.lock:
+            self.push_datum(element)
+            if fmt == "ndjson":
+                row = {field: element.get(field) for field in self.get_headings()}
+                output = self.ndjson_line(row)
+            else:
+                output = self.table_rows(element)
+            print(output, end="", file=file or sys.stdout, flush=True)
+
+    def table_rows(self, element):
+        """Get the table lines of a just pushed element, with the header if first"""
+        dims = self.get_dimensions()
+        output = ""
+        if len(self.data) == 1:
+            output += self.liner(dims) + self.header(dims) + self.liner(dims)
+        return output + self.data_line(element, dims)
+
+    def stream_end(self, file=None):
+        """Close a streamed table"""
+        with self.lock:
+            if self.data:
+                print(self.liner(), end="", file=file or sys.stdout, flush=True)
 
     def get_table(self):
         """Get the table of data"""
-        output = self.liner()
-        output += self.header()
-        output += self.liner()
-        output += self.data_lines()
-        output += self.liner()
-        return output
+        liner = self.liner()
+        return "".join([liner, self.header(), liner, self.data_lines(), liner])
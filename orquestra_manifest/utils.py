@@ -1,13 +1,20 @@
 """Utils for this package"""
+import contextlib
+import hashlib
 import logging
-import os
 import pathlib
-import re
-import subprocess
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
 from enum import Enum, unique
 
 import git
-from git.exc import BadName, GitCommandError, InvalidGitRepositoryError
+from git.exc import GitCommandError, InvalidGitRepositoryError
+
+from orquestra_manifest import runner
+from orquestra_manifest.profiler import span
 
 logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger("orquestra_manifest.utils")
@@ -24,67 +31,224 @@ class RefType(Enum):
 
 
 class _HashCache:
-    """Keep track of what was hashed"""
+    """Keep track of what was hashed, to tell repeated messages apart.
+
+    * Holds at most maxsize hashes, the least recently seen are forgotten first.
+    * suppressed counts the hashes that were seen again.
+    * Safe to use from several threads.
+    """
+
+    MAXSIZE = 4096
+
+    def __init__(self, maxsize=MAXSIZE):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.suppressed = 0
+        self.lock = threading.Lock()
 
-    cache: set([int]) = set()
+    def __contains__(self, hashed):
+        """Test if element is present, without adding it"""
+        with self.lock:
+            return hashed in self.cache
+
+    def add(self, hashed):
+        """Add element, or mark it as the most recently seen"""
+        with self.lock:
+            self._add(hashed)
+
+    def _add(self, hashed):
+        self.cache[hashed] = None
+        self.cache.move_to_end(hashed)
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
 
     def has_element(self, hashed):
         """Test if element is present, add it if not"""
-        if hashed in self.cache:
-            return True
-        self.cache.add(hashed)
-        return False
+        with self.lock:
+            if hashed in self.cache:
+                self.cache.move_to_end(hashed)
+                self.suppressed += 1
+                return True
+            self._add(hashed)
+            return False
 
     def clear(self):
         """Clear the cache"""
-        self.cache = set()
+        with self.lock:
+            self.cache.clear()
+            self.suppressed = 0
+
+    def summary(self):
+        """One line summary of the suppressed messages"""
+        return f"Suppressed {self.suppressed} repeated messages"
+
+
+# Stack of message scopes, the last one is in use. The first one lasts forever.
+_HASH_CACHES = [_HashCache()]
+_HASH_CACHES_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def message_scope(maxsize=_HashCache.MAXSIZE):
+    """Deduplicate the messages of _print_unique within the block, in every thread.
+
+    yields: the _HashCache of the block
+    """
+    hashcache = _HashCache(maxsize)
+    with _HASH_CACHES_LOCK:
+        _HASH_CACHES.append(hashcache)
+    try:
+        yield hashcache
+    finally:
+        with _HASH_CACHES_LOCK:
+            _HASH_CACHES.remove(hashcache)
+
 
+_PRINT_LOCK = threading.Lock()
 
-def _print_unique(message):
-    """Print all unique messages not in _HashCache"""
-    hashcache = _HashCache()
+
+def _print_line(message):
+    """Print message as one write, so lines of several threads do not mix"""
+    with _PRINT_LOCK:
+        sys.stdout.write(f"{message}\n")
+        sys.stdout.flush()
+
+
+def _print_unique(message, hashcache=None):
+    """Print message unless hashcache saw it, the one of the current scope by default"""
+    if hashcache is None:
+        hashcache = _HASH_CACHES[-1]
     hashed = hash(message)
     if not hashcache.has_element(hashed):
-        print(message)
+        _print_line(message)
 
 
-def run_command(command, stdout=False, verbose=False):
+class _OutputPrinter:
+    """Print the lines of one process output, and collapse a repeat of a whole output.
+
+    * Lines are printed as they come. Lines are only held back while all the lines
+      so far start an output that hashcache already saw, and only for the first
+      MAX_LINES lines: they are printed as soon as one differs.
+    * An output that matches an earlier one line for line is not printed again.
+    * No line of an output is dropped otherwise, repeated lines included.
+    """
+
+    MAX_LINES = 100
+
+    def __init__(self, hashcache):
+        self.hashcache = hashcache
+        self.held = []
+        self.prefixes = []
+        self.hashed = None
+        self.live = False
+
+    def line(self, message):
+        """Handle the next line of the output"""
+        if len(self.prefixes) <= self.MAX_LINES:
+            self.hashed = hash((self.hashed, message))
+            self.prefixes.append(self.hashed)
+        if self.live:
+            _print_line(message)
+            return
+        self.held.append(message)
+        if len(self.held) > self.MAX_LINES or self.hashed not in self.hashcache:
+            self._flush()
+
+    def _flush(self):
+        """Print the held lines, and the next ones as they come"""
+        for message in self.held:
+            _print_line(message)
+        self.held = []
+        self.live = True
+
+    def close(self):
+        """End of the output: drop it if it repeats a whole earlier one"""
+        if not self.prefixes:
+            return
+        if not self.live and self.hashcache.has_element(hash((self.hashed, None))):
+            return
+        self._flush()
+        if len(self.prefixes) <= self.MAX_LINES:
+            for prefix in self.prefixes:
+                self.hashcache.add(prefix)
+            self.hashcache.add(hash((self.hashed, None)))
+
+
+def run_command(
+    command,
+    stdout=False,
+    verbose=False,
+    cwd=None,
+    prefix=None,
+    timeout=None,
+    hashcache=None,
+):
     """Run a command, handle output.
 
     * Command : list of system strings.
-    * Return : (int) the return code of the process, per Posix conventions.
+    * cwd : working directory of the process, default is the current directory.
+    * Output is printed line by line as it comes: stdout lines if stdout, stderr
+      lines always. Lines start with "[prefix] " if prefix is given.
+    * Unless verbose, a stderr output that repeats a whole earlier one line for line
+      is printed once, see _OutputPrinter.
+    * hashcache : _HashCache of the stderr outputs already printed, the one of the
+      current message_scope() by default. Pass a new one to deduplicate per command.
+    * timeout : seconds after which the process is stopped, with error 124.
+    * Return : (int) the return code of the process, per Posix conventions. The
+      errno of the failure if the process can't be started, else 126.
     """
 
     if verbose:
         print(f"Running: {command}")
 
+    if hashcache is None:
+        hashcache = _HASH_CACHES[-1]
+    errors = _OutputPrinter(hashcache)
+
+    def on_line(stream, line):
+        message = f"[{prefix}] {line}" if prefix else line
+        if stream == "stdout":
+            if stdout:
+                _print_line(message)
+        elif verbose:
+            _print_line(message)
+        else:
+            errors.line(message)
+
     try:
-        proc = subprocess.run(command, shell=False, capture_output=True)
+        result = runner.run(command, cwd=cwd, on_line=on_line, timeout=timeout)
     except Exception as ex:
         print(f"Exception running command {command}: {ex}")
-        return ex.errno
+        return getattr(ex, "errno", None) or runner.START_ERROR
+    finally:
+        errors.close()
 
-    if stdout:
-        print(proc.stdout.decode())
+    return result.returncode
 
-    if verbose:
-        print(proc.stderr.decode())
-    else:
-        _print_unique(proc.stderr.decode())
-
-    return proc.returncode
 
+def folder_cmd(folder, cmd, verbose=False, stdout=False, timeout=None):
+    """Execute cmd on pathlib.Path folder
 
-def folder_cmd(folder, cmd, verbose=False, stdout=False):
-    """Execute cmd on pathlib.Path folder"""
+    * The process runs with folder as its working directory, the current directory of
+      this process is left alone. This makes it safe to call from several threads.
+    * Output lines are prefixed with the folder name.
+    """
     error = 0
     folder_name = folder.resolve().name
     cmd_string = " ".join(cmd)
     LOG.info("Executing '%s' on %s", cmd_string, folder_name)
     LOG.info("-" * 60)
     try:
-        os.chdir(folder)
-        error = run_command(cmd, verbose=verbose, stdout=stdout)
+        if not folder.is_dir():
+            raise FileNotFoundError(f"No such folder: {folder}")
+        error = run_command(
+            cmd,
+            verbose=verbose,
+            stdout=stdout,
+            cwd=folder,
+            prefix=folder_name,
+            timeout=timeout,
+        )
     except Exception as ex:
         LOG.warning("Failed to '%s' on %s: %s", cmd_string, folder_name, ex)
         error = 100
@@ -200,31 +364,86 @@ def get_tag(repo):
 
     returns: git.TagReference object or None
     """
-    return next((tag for tag in repo.tags if tag.commit == repo.head.commit), None)
+    name = get_tag_name(repo)
+    if name:
+        return git.TagReference(repo, f"refs/tags/{name}")
+    return None
 
 
 def get_tag_name(repo):
     """Get tag name of repo if it exists, else None.
 
+    * Tags are looked up by HEAD sha in the RefIndex of repo.
+
     returns: String or None
     """
-    tag = next((tag for tag in repo.tags if tag.commit == repo.head.commit), None)
-    if tag:
-        return tag.name
+    names = get_ref_index(repo).tags_at(repo.head.commit.hexsha)
+    if names:
+        return names[0]
     return None
 
 
+def get_tree_fingerprint(repo):
+    """Fingerprint the working tree of repo: its HEAD plus any local change.
+
+    * Local changes are the binary diff against HEAD and the path, size and mtime
+      of every untracked, not ignored file.
+
+    returns: string "<head sha>" for a clean tree, else "<head sha>+<digest>"
+    """
+    head = repo.head.commit.hexsha
+    digest = hashlib.sha256()
+    digest.update(repo.git.diff("HEAD", "--binary").encode())
+
+    untracked = repo.git.ls_files("--others", "--exclude-standard", "-z")
+    for path in sorted(filter(None, untracked.split("\0"))):
+        try:
+            stat = (pathlib.Path(repo.working_dir) / path).stat()
+        except OSError:
+            continue
+        digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\0".encode())
+
+    if digest.digest() == hashlib.sha256().digest():
+        return head
+    return f"{head}+{digest.hexdigest()[:16]}"
+
+
+def tree_changed_since(repo, old_fingerprint, fingerprint):
+    """Did the tree of repo change from old_fingerprint to fingerprint?
+
+    * Fingerprints come from get_tree_fingerprint().
+    * Different clean commits are compared with git diff, so commits that leave the
+      tree alone (merges, reverts) are not a change.
+    """
+    if old_fingerprint == fingerprint:
+        return False
+    if not old_fingerprint or "+" in old_fingerprint or "+" in fingerprint:
+        return True
+
+    try:
+        repo.git.diff("--quiet", old_fingerprint, fingerprint)
+    except GitCommandError:
+        # Exit code 1: there are differences, else the old commit is unknown.
+        return True
+    return False
+
+
 def git_pull_change(repo, ref):
     """Pull the repo and detect if current position was changed
 
+    * The pull is a span of the profile, if any.
+
     return: state string: [changed, unchanged, invalid]
     """
     current = repo.head.commit
     try:
-        repo.remotes.origin.pull(ref)
+        with span("git pull", "git", repo=pathlib.Path(repo.working_dir).name):
+            repo.remotes.origin.pull(ref)
     except Exception as ex:
         LOG.warning("Git state is quite broken for %s: %s", ref, ex)
         return "unchanged"
+    finally:
+        invalidate_ref_index(repo)
 
     repo_name = repo.working_dir.split("/")[-1]
 
@@ -242,83 +461,344 @@ def git_pull_change(repo, ref):
     return "unchanged"
 
 
-def ref_in_refs(repo, ref):
-    """Is this ref a tag?"""
-    refs = []
-    for _ref in repo.refs:
-        refs.append(_ref.name)
+def is_shallow(repo):
+    """Is repo a shallow clone?"""
+    return pathlib.Path(repo.git_dir, "shallow").exists()
+
+
+def fetch_ref(repo, ref, depth=None):
+    """Fetch a single tag or commit of origin, that a shallow clone may lack.
+
+    return: bool, True if ref was fetched.
+    """
+    options = [f"--depth={depth}"] if depth else []
+    try:
+        for refspec in (["tag", ref], [ref]):
+            try:
+                repo.git.fetch(*options, "origin", *refspec)
+                return True
+            except GitCommandError as ex:
+                LOG.debug("Can't fetch %s %s: %s", " ".join(refspec), repo, ex)
+        return False
+    finally:
+        invalidate_ref_index(repo)
+
+
+def get_worktree_bool(repo, name):
+    """Get the boolean git config name of repo, False if unset.
+
+    * Reads config.worktree too, which the GitPython config reader does not read.
+    """
+    try:
+        return repo.git.config("--bool", name) == "true"
+    except GitCommandError:
+        return False
+
+
+def set_sparse(repo, paths):
+    """Limit the work tree of repo to the folders of paths, all of it if no paths.
+
+    * Uses cone mode sparse checkout, files at the top of the repo are kept. Cone
+      mode is asked for with 'sparse-checkout init --cone', which needs git 2.25 or
+      later: plain 'sparse-checkout set' only defaults to cone mode from git 2.37.
+    * Does nothing when the repo already matches paths.
+
+    return: bool, True if the sparse checkout changed.
+    """
+    sparse = get_worktree_bool(repo, "core.sparseCheckout")
+    if not paths:
+        if not sparse:
+            return False
+        repo.git.sparse_checkout("disable")
+        return True
+
+    paths = [path.strip("/") for path in paths]
+    cone = sparse and get_worktree_bool(repo, "core.sparseCheckoutCone")
+    # Folders are listed sorted, whatever the order they were set in.
+    if cone and sorted(repo.git.sparse_checkout("list").split()) == sorted(paths):
+        return False
+    if not cone:
+        repo.git.sparse_checkout("init", "--cone")
+    repo.git.sparse_checkout("set", *paths)
+    return True
+
+
+def git_fast_forward(repo, ref):
+    """Checkout ref and fast-forward it to its fetched remote branch, no network.
+
+    * Tags and commits are only checked out.
+    * The remote branch comes from an earlier 'morq fetch'.
+
+    return: state string: [changed, unchanged, invalid]
+    """
+    current = repo.head.commit
+    repo_name = repo.working_dir.split("/")[-1]
+
+    try:
+        repo.git.checkout(ref)
+    except GitCommandError as ex:
+        LOG.warning("Git reference %s invalid for %s: %s", ref, repo_name, ex)
+        return "invalid"
+
+    try:
+        if get_ref_index(repo).is_branch("origin/" + ref):
+            repo.git.merge("--ff-only", "origin/" + ref)
+    except GitCommandError as ex:
+        LOG.warning("Can't fast-forward %s of %s: %s", ref, repo_name, ex)
+    finally:
+        invalidate_ref_index(repo)
+
+    if current != repo.head.commit:
+        LOG.debug("Git state changed: %s", repo_name)
+        return "changed"
 
-    return any(_ref in refs for _ref in [ref, "origin/" + ref, "remotes/origin/" + ref])
+    LOG.debug("Git state unchanged: %s", repo_name)
+    return "unchanged"
+
+
+class RefIndex:
+    """Index of the refs of a repo, built from a single 'git for-each-ref' call.
+
+    * names: short names of every branch, remote branch and tag, as in repo.refs
+    * branches: local branches ("main") and remote branches ("origin/main" and
+      "remotes/origin/main"), as listed by 'git branch --all'
+    * tags: dict of tag name: commit sha, annotated tags are peeled
+    * tags_by_sha: dict of commit sha: list of tag names, in refname order
+    * shas: dict of short name: commit sha
+    * The index holds a weak reference to repo, so it never keeps repo alive.
+    """
+
+    FORMAT = "%(refname)%00%(objectname)%00%(*objectname)"
+
+    def __init__(self, repo):
+        self._repo = weakref.ref(repo)
+        self.names = set()
+        self.branches = set()
+        self.tags = {}
+        self.tags_by_sha = {}
+        self.shas = {}
+
+        output = repo.git.for_each_ref(f"--format={self.FORMAT}")
+        for line in output.splitlines():
+            refname, sha, peeled = line.split("\0")
+            sha = peeled or sha
+            if refname.startswith("refs/heads/"):
+                name = refname[len("refs/heads/") :]
+                self.branches.add(name)
+            elif refname.startswith("refs/remotes/"):
+                name = refname[len("refs/remotes/") :]
+                if name.endswith("/HEAD"):
+                    continue
+                self.branches.update([name, "remotes/" + name])
+            elif refname.startswith("refs/tags/"):
+                name = refname[len("refs/tags/") :]
+                self.tags[name] = sha
+                self.tags_by_sha.setdefault(sha, []).append(name)
+            else:
+                continue
+            self.names.add(name)
+            self.shas[name] = sha
+
+    @property
+    def repo(self):
+        """The git.Repo of the index"""
+        return self._repo()
+
+    @staticmethod
+    def candidates(ref):
+        """Names that ref can take in the index"""
+        return [ref, "origin/" + ref, "remotes/origin/" + ref]
+
+    def has_ref(self, ref):
+        """Is ref a branch, remote branch or tag?"""
+        return any(name in self.names for name in self.candidates(ref))
+
+    def is_branch(self, ref):
+        """Is ref a local or remote branch?"""
+        return any(name in self.branches for name in self.candidates(ref))
+
+    def is_tag(self, ref):
+        """Is ref a tag?"""
+        return ref in self.tags
+
+    def is_commit(self, ref):
+        """Is ref a commit, and not a branch or tag?"""
+        if ref in self.names:
+            return False
+        return self.resolve(ref) is not None
+
+    def tags_at(self, sha):
+        """Get the names of the tags pointing at commit sha"""
+        return self.tags_by_sha.get(sha, [])
+
+    def resolve(self, ref):
+        """Get the commit sha of ref, None if it does not exist"""
+        if ref in self.shas:
+            return self.shas[ref]
+        try:
+            return self.repo.git.rev_parse("--verify", "--quiet", ref + "^{commit}")
+        except GitCommandError:
+            return None
+
+
+_REF_INDEX_LOCK = threading.Lock()
+
+
+def get_ref_index(repo):
+    """Get the RefIndex of repo, it is built once per git.Repo object.
+
+    * The index is kept on the repo object, and goes away with it. Two git.Repo
+      objects of the same folder have an index each.
+    * Call invalidate_ref_index() after changing the refs of repo.
+    """
+    with _REF_INDEX_LOCK:
+        ref_index = getattr(repo, "_morq_ref_index", None)
+    if ref_index is None:
+        ref_index = RefIndex(repo)
+        with _REF_INDEX_LOCK:
+            repo._morq_ref_index = ref_index
+    return ref_index
+
+
+def invalidate_ref_index(repo):
+    """Forget the RefIndex of repo, it gets rebuilt on next use"""
+    with _REF_INDEX_LOCK:
+        repo._morq_ref_index = None
+
+
+def ref_in_refs(repo, ref):
+    """Is this ref a branch, remote branch or tag?"""
+    return get_ref_index(repo).has_ref(ref)
 
 
 def ref_is_tag(repo, ref):
     """Is this ref a tag?"""
-    if ref in repo.tags:
-        return True
-    return False
+    return get_ref_index(repo).is_tag(ref)
 
 
 def ref_is_branch(repo, ref):
     """Is this ref a branch?
 
     * This questions is not obvious if the local version only has limited refs.
-    * This is why we have to get a full set of branches from remote.
+    * This is why we look at remote branches too.
     """
-    # repo.git.branch() is a string
-    _branches = repo.git.branch("--all").split()
-    # Pattern for good branch names
-    pattern = re.compile(r"^[\w\/\-]+$")
-    # Filter out funky special chars out of branches to be sure.
-    branches = [i for i in _branches if pattern.match(i)]
-
-    return any(
-        _ref in branches for _ref in [ref, "origin/" + ref, "remotes/origin/" + ref]
-    )
+    return get_ref_index(repo).is_branch(ref)
 
 
 def ref_is_commit(repo, ref):
-    """Is this ref a tag?"""
-
-    # First test if ref is a branch or tag:
-    if ref in repo.references:
-        return False
-
-    try:
-        _ = repo.commit(ref)
-    except BadName:
-        return False
-    else:
-        return True
+    """Is this ref a commit?"""
+    return get_ref_index(repo).is_commit(ref)
 
 
 def get_repo_ref_type(repo, ref):
     """Return the reference type as RefType, if possible, else RefType.UNKNOWN"""
+    ref_index = get_ref_index(repo)
 
-    if ref_is_branch(repo, ref):
+    if ref_index.is_branch(ref):
         return RefType.BRANCH
-    if ref_is_tag(repo, ref):
+    if ref_index.is_tag(ref):
         return RefType.TAG
-    if ref_is_commit(repo, ref):
+    if ref_index.is_commit(ref):
         return RefType.COMMIT
 
     return RefType.UNKNOWN
 
 
-def get_repo_ref_state_ok(repo, ref):
-    """Determine if state of repo is ok"""
-    ref_type = get_repo_ref_type(repo, ref)
-
-    if ref_type.name == "BRANCH":
-        if ref in repo.active_branch.name and "is up to date" in repo.git.status():
-            return True
-    elif ref_type.name == "TAG":
-        if ref in repo.git.status():
-            return True
-    elif ref_type.name == "COMMIT":
-        if ref in repo.commit().hexsha:
-            return True
+@dataclass
+class RepoState:
+    """State of a repo compared to a manifest ref
 
-    return False
+    * head_ref: "refs/heads/<branch>", or "HEAD" when detached.
+    * ref_sha: the commit the repo should be at, the upstream for branches.
+    * ahead, behind: commits of HEAD missing from ref_sha, and the opposite.
+    * exact: False when the history of a shallow repo is cut before the merge
+      base, ahead and behind are then lower bounds.
+    * dirty: tracked files have changes, None when not probed.
+    """
+
+    ref: str
+    ref_type: RefType
+    head_sha: str
+    head_ref: str
+    ref_sha: str = None
+    ahead: int = 0
+    behind: int = 0
+    exact: bool = True
+    dirty: bool = None
+
+    @property
+    def on_ref(self):
+        """Is HEAD on the ref: its branch, detached for a tag, anywhere for a commit"""
+        if self.ref_type == RefType.BRANCH:
+            return self.head_ref == f"refs/heads/{self.ref}"
+        if self.ref_type == RefType.TAG:
+            return self.head_ref == "HEAD"
+        return self.ref_type == RefType.COMMIT
+
+    @property
+    def ok(self):
+        """Is HEAD on the ref, and in sync with it"""
+        return (
+            self.on_ref
+            and self.ref_sha is not None
+            and self.ahead == 0
+            and self.behind == 0
+        )
+
+
+def count_ahead_behind(repo, base, target):
+    """Count the commits of base missing from target, and the opposite.
+
+    returns: (int ahead, int behind)
+    """
+    output = repo.git.rev_list("--left-right", "--count", f"{base}...{target}")
+    ahead, behind = output.split()
+    return int(ahead), int(behind)
+
+
+def get_repo_state(repo, ref, check_dirty=True):
+    """Probe the state of repo against ref with a few plumbing commands.
+
+    * for-each-ref (shared through get_ref_index), rev-parse, and when needed
+      rev-list --left-right --count and status --porcelain=v2.
+    * Branches are compared to their "origin/" remote branch, if there is one.
+
+    returns: RepoState
+    """
+    ref_index = get_ref_index(repo)
+    head_sha, head_ref = repo.git.rev_parse(
+        "HEAD", "--symbolic-full-name", "HEAD"
+    ).split()
+
+    if ref_index.is_branch(ref):
+        ref_type = RefType.BRANCH
+        ref_sha = ref_index.shas.get("origin/" + ref) or ref_index.shas.get(ref)
+    elif ref_index.is_tag(ref):
+        ref_type = RefType.TAG
+        ref_sha = ref_index.tags[ref]
+    else:
+        ref_sha = ref_index.resolve(ref)
+        ref_type = RefType.COMMIT if ref_sha else RefType.UNKNOWN
+
+    state = RepoState(ref, ref_type, head_sha, head_ref, ref_sha)
+    if ref_sha and ref_sha != head_sha:
+        state.ahead, state.behind = count_ahead_behind(repo, head_sha, ref_sha)
+        if state.ahead and state.behind and is_shallow(repo):
+            try:
+                repo.git.merge_base(head_sha, ref_sha)
+            except GitCommandError:
+                state.exact = False
+
+    if check_dirty:
+        status = repo.git.status("--porcelain=v2", "--untracked-files=no")
+        state.dirty = bool(status.strip())
+
+    return state
+
+
+def get_repo_ref_state_ok(repo, ref):
+    """Determine if state of repo is ok: on the ref, and in sync with it"""
+    return get_repo_state(repo, ref, check_dirty=False).ok
 
 
 # Pathlib missing features
@@ -0,0 +1,101 @@
+"""Shared fixtures: local bare Git repos that act as manifest remotes"""
+import json
+import pathlib
+
+import git
+import pytest
+
+LOCAL_REPOS = ("alpha", "beta", "gamma")
+
+
+def make_remote(base, name, tag="v1.0.0"):
+    """Create a bare repo at base/remotes/name.git with a main branch and a tag.
+
+    returns: pathlib.Path of the bare repo
+    """
+    seed_path = base / "seeds" / name
+    seed = git.Repo.init(seed_path, initial_branch="main")
+    with seed.config_writer() as config:
+        config.set_value("user", "name", "Morq Tester")
+        config.set_value("user", "email", "morq@example.com")
+
+    (seed_path / "Makefile").write_text(
+        "install:\n\t@echo ok\ndev:\n\t@echo ok\ntest:\n\t@echo ok\n"
+    )
+    (seed_path / f"{name}.py").write_text(f'"""{name}"""\n')
+    seed.index.add(["Makefile", f"{name}.py"])
+    seed.index.commit(f"Initial commit for {name}")
+    seed.create_tag(tag)
+
+    remote_path = base / "remotes" / f"{name}.git"
+    seed.clone(remote_path, bare=True)
+    return remote_path
+
+
+def push_commit(base, name, file_name="change.txt", text="change\n"):
+    """Add a commit to the remote of name, through its seed repo"""
+    seed_path = base / "seeds" / name
+    seed = git.Repo(seed_path)
+    (seed_path / file_name).write_text(text)
+    seed.index.add([file_name])
+    seed.index.commit(f"Change {file_name}")
+    remote_path = base / "remotes" / f"{name}.git"
+    seed.git.push(remote_path.as_posix(), "main", "--tags")
+
+
+@pytest.fixture(autouse=True, scope="session")
+def session_mirrors(tmp_path_factory):
+    """Keep the mirror cache of every test out of the real ~/.cache/morq/mirrors"""
+    with pytest.MonkeyPatch.context() as session_patch:
+        mirror_root = tmp_path_factory.mktemp("mirrors")
+        session_patch.setenv("MORQ_MIRRORS", mirror_root.as_posix())
+        yield mirror_root
+
+
+@pytest.fixture
+def git_identity(monkeypatch):
+    """Make sure commits can be made without a global Git config"""
+    monkeypatch.setenv("GIT_AUTHOR_NAME", "Morq Tester")
+    monkeypatch.setenv("GIT_AUTHOR_EMAIL", "morq@example.com")
+    monkeypatch.setenv("GIT_COMMITTER_NAME", "Morq Tester")
+    monkeypatch.setenv("GIT_COMMITTER_EMAIL", "morq@example.com")
+
+
+@pytest.fixture
+def mirrors(tmp_path, monkeypatch):
+    """Keep the mirror cache in the test folder
+
+    returns: pathlib.Path of the mirror cache
+    """
+    mirror_root = tmp_path / "mirrors"
+    monkeypatch.setenv("MORQ_MIRRORS", mirror_root.as_posix())
+    return mirror_root
+
+
+@pytest.fixture
+def local_manifest(tmp_path, git_identity, mirrors):
+    """A manifest.json pointing at local bare repos, plus one broken entry.
+
+    returns: pathlib.Path of manifest.json
+    """
+    repos = {}
+    for name in LOCAL_REPOS:
+        remote_path = make_remote(tmp_path, name)
+        repos[name] = {
+            "url": remote_path.as_uri(),
+            "ref": "main",
+            "type": "python",
+            "autodoc": [],
+        }
+    repos["missing"] = {
+        "url": (tmp_path / "remotes" / "missing.git").as_uri(),
+        "ref": "main",
+        "type": "python",
+        "autodoc": [],
+    }
+
+    workspace = pathlib.Path(tmp_path / "workspace")
+    workspace.mkdir()
+    manifest_file = workspace / "manifest.json"
+    manifest_file.write_text(json.dumps({"version": "1.0.0", "repos": repos}))
+    return manifest_file
@@ -0,0 +1,296 @@
+"""Test copyright module"""
+import json
+import logging
+import pathlib
+import re
+import sys
+
+import git
+import pytest
+from git.exc import GitCommandError
+from conftest import LOCAL_REPOS
+
+from orquestra_manifest import copyright as copyright_module
+from orquestra_manifest.copyright import (
+    HEADER_WINDOW,
+    copy_brand,
+    folder_walk,
+    get_file_jobs,
+    get_path_years,
+    insert_copyright,
+    list_repo_files,
+    make_pythonic_copyright,
+    read_header,
+)
+from orquestra_manifest.morq import Manifest
+
+logging.basicConfig(level=logging.DEBUG)
+LOG = logging.getLogger()
+
+
+def commit_files(repo, files, year, monkeypatch):
+    """Commit files (dict of path: text) in repo, dated in year"""
+    for path, text in files.items():
+        (pathlib.Path(repo.working_dir) / path).write_text(text, encoding="utf-8")
+    repo.index.add(list(files))
+    date = f"{year}-06-01T12:00:00"
+    monkeypatch.setenv("GIT_COMMITTER_DATE", date)
+    repo.index.commit(f"Commit of {year}", author_date=date, commit_date=date)
+
+
+class TestCopyright:
+    """Test the copyright module"""
+
+    @pytest.fixture
+    def history_repo(self, tmp_path, monkeypatch, git_identity):
+        """A repo with a few years of history, and a rename"""
+        repo = git.Repo.init(tmp_path / "history", initial_branch="main")
+        commit_files(repo, {"old.py": "old\n"}, 2018, monkeypatch)
+        commit_files(repo, {"a.py": "a\n"}, 2019, monkeypatch)
+        commit_files(repo, {"b.py": "b\n"}, 2020, monkeypatch)
+        commit_files(repo, {"a.py": "a2\n"}, 2021, monkeypatch)
+        repo.git.mv("old.py", "new.py")
+        commit_files(repo, {"new.py": "old\n"}, 2022, monkeypatch)
+        return repo
+
+    def test_get_path_years(self, history_repo):
+        years = get_path_years(history_repo)
+        assert years["a.py"] == (2019, 2021)
+        assert years["b.py"] == (2020, 2020)
+        assert years["new.py"] == (2022, 2022)
+        assert years["old.py"] == (2018, 2018)
+
+    def test_get_path_years_follow_renames(self, history_repo):
+        years = get_path_years(history_repo, follow_renames=True)
+        assert years["a.py"] == (2019, 2021)
+        assert years["new.py"] == (2018, 2022)
+
+    def test_get_path_years_names(self, history_repo, monkeypatch):
+        """Names git would quote are read as they are"""
+        names = {'we"ird.py': "w\n", "back\\slash.py": "b\n", "tab\there.py": "t\n"}
+        commit_files(history_repo, names, 2023, monkeypatch)
+        history_repo.git.commit("--allow-empty", "-m", "Empty")
+        commit_files(history_repo, {"sp ace.py": "s\n"}, 2024, monkeypatch)
+        years = get_path_years(history_repo)
+        assert {name: years[name] for name in names} == dict.fromkeys(
+            names, (2023, 2023)
+        )
+        assert years["sp ace.py"] == (2024, 2024)
+        assert years["a.py"] == (2019, 2021)
+        assert get_path_years(history_repo, paths=['we"ird.py']) == {
+            'we"ird.py': (2023, 2023)
+        }
+        assert get_path_years(history_repo, follow_renames=True)["new.py"] == (
+            2018,
+            2022,
+        )
+
+    def test_get_path_years_error(self, history_repo):
+        history_repo.git.update_ref("HEAD", "0" * 40, "--no-deref")
+        with pytest.raises(GitCommandError, match="fatal: "):
+            get_path_years(history_repo)
+
+    def test_folder_walk(self, history_repo):
+        (pathlib.Path(history_repo.working_dir) / "untracked.py").write_text("new\n")
+        seen = {}
+
+        def command(first_year, last_year, path):
+            seen[path.split("/")[-1]] = (first_year, last_year)
+
+        folder_walk(history_repo, command)
+        assert seen == {
+            "a.py": (2019, 2021),
+            "b.py": (2020, 2020),
+            "new.py": (2022, 2022),
+        }
+
+    def test_folder_walk_no_change(self, history_repo, monkeypatch):
+        """Nothing changed, nothing is walked, not even the history"""
+        monkeypatch.setattr(
+            "orquestra_manifest.copyright.get_path_years",
+            lambda *args, **kwargs: pytest.fail("The history was walked"),
+        )
+        assert folder_walk(history_repo, print, paths=set()) == []
+        assert folder_walk(history_repo, print, paths={"notes.txt"}) == []
+
+    def test_copy_brand(self, local_manifest, capsys):
+        Manifest(local_manifest, jobs=4).update_repos()
+        capsys.readouterr()
+
+        copy_brand("TICKET-1", jobs=4, push=False, manifest_file=local_manifest)
+        out = capsys.readouterr().out
+        for name in LOCAL_REPOS:
+            assert re.search(rf"{name} .*\| 2 .*\| 0 ", out)
+            repo = git.Repo(local_manifest.parent / name)
+            assert repo.active_branch.name == "TICKET-1"
+            assert "Copyright" in repo.head.commit.message
+            assert (
+                "© Copyright" in (local_manifest.parent / name / "Makefile").read_text()
+            )
+
+        # Nothing left to change: nothing committed.
+        copy_brand(
+            "TICKET-1", jobs=4, push=False, manifest_file=local_manifest, full=True
+        )
+        out = capsys.readouterr().out
+        assert re.search(r"alpha .*\| 0 .*\| 2 ", out)
+
+    def test_get_file_jobs(self):
+        assert get_file_jobs(1, 4) == 1
+        assert get_file_jobs(8, 2) == 4
+        assert get_file_jobs(8, 20) == 1
+        assert get_file_jobs(0, 4) == 1
+        assert get_file_jobs(4, 0) == 4
+
+    def test_copyright_all_jobs(self, local_manifest, capsys, monkeypatch):
+        """-j 0 stamps every repo at the same time, as with morq"""
+        Manifest(local_manifest).update_repos()
+        capsys.readouterr()
+        calls = []
+        copy = copyright_module.copy_brand
+
+        def spy(**kwargs):
+            calls.append(kwargs)
+            return copy(**kwargs)
+
+        monkeypatch.setattr(copyright_module, "copy_brand", spy)
+        argv = [
+            "",
+            "-m",
+            str(local_manifest),
+            "--ticket",
+            "T-0",
+            "--no-push",
+            "-j",
+            "0",
+        ]
+        monkeypatch.setattr(sys, "argv", argv)
+        copyright_module.copyright()
+        assert calls[0]["jobs"] == 0
+        assert calls[0]["file_jobs"] is None
+        assert re.search(r"gamma .*\| 2 ", capsys.readouterr().out)
+
+    def test_insert_copyright(self, tmp_path):
+        body = "x = 1\n" * 100000
+        file = tmp_path / "big.py"
+        file.write_text("import os\n" + body)
+
+        report = insert_copyright(2020, 2022, file.as_posix(), dry_run=True)
+        assert "+# © Copyright 2020-2022 Zapata Computing Inc." in report["diff"]
+        assert file.read_text() == "import os\n" + body
+
+        report = insert_copyright(2020, 2022, file.as_posix())
+        assert report["first_year"] == 2020
+        text = file.read_text()
+        assert text.endswith("import os\n" + body)
+        assert text.startswith(make_pythonic_copyright("2020-2022"))
+
+        # Unchanged files are not written.
+        mtime = file.stat().st_mtime_ns
+        assert insert_copyright(2020, 2022, file.as_posix()) is None
+        assert file.stat().st_mtime_ns == mtime
+
+        # Copyrights past the header window are not looked for.
+        assert read_header(file.as_posix(), window=100)[1] <= 100
+        report = insert_copyright(2020, 2023, file.as_posix())
+        assert "© Copyright 2020-2023" in file.read_text()[:HEADER_WINDOW]
+
+    def test_copy_brand_dry_run(self, local_manifest, capsys):
+        Manifest(local_manifest).update_repos()
+        capsys.readouterr()
+
+        copy_brand(
+            "TICKET-2", dry_run=True, report="json", manifest_file=local_manifest
+        )
+        report = json.loads(capsys.readouterr().out)
+        assert sorted(report) == sorted(LOCAL_REPOS)
+        assert sorted(change["path"] for change in report["alpha"]) == [
+            "Makefile",
+            "alpha.py",
+        ]
+        repo = git.Repo(local_manifest.parent / "alpha")
+        assert repo.active_branch.name == "main"
+        assert not repo.is_dirty()
+
+        copy_brand("TICKET-2", dry_run=True, manifest_file=local_manifest)
+        out = capsys.readouterr().out
+        assert "+# © Copyright" in out
+        assert not repo.is_dirty()
+
+    def test_list_repo_files(self, history_repo, monkeypatch):
+        (pathlib.Path(history_repo.working_dir) / "untracked.py").write_text("new\n")
+        (pathlib.Path(history_repo.working_dir) / "vendor").mkdir()
+        commit_files(
+            history_repo, {"vendor/v.py": "v\n", "notes.txt": "n\n"}, 2023, monkeypatch
+        )
+
+        assert list_repo_files(history_repo) == [
+            "a.py",
+            "b.py",
+            "new.py",
+            "vendor/v.py",
+        ]
+        assert list_repo_files(history_repo, include=["vendor/*"]) == ["vendor/v.py"]
+        assert list_repo_files(history_repo, exclude=["vendor/*", "b.*"]) == [
+            "a.py",
+            "new.py",
+        ]
+        assert list_repo_files(history_repo, extensions=(".txt",)) == ["notes.txt"]
+
+    def test_list_repo_files_missing(self, history_repo, monkeypatch):
+        """Deleted files, and files outside a sparse checkout, are not listed"""
+        (pathlib.Path(history_repo.working_dir) / "docs").mkdir()
+        commit_files(history_repo, {"docs/c.py": "c\n"}, 2023, monkeypatch)
+        (pathlib.Path(history_repo.working_dir) / "b.py").unlink()
+        assert list_repo_files(history_repo) == ["a.py", "docs/c.py", "new.py"]
+
+        history_repo.git.checkout("--", "b.py")
+        # The index written by GitPython has to be refreshed, for git to see the
+        # files are clean and drop them from the work tree.
+        history_repo.git.update_index("--refresh")
+        history_repo.git.sparse_checkout("set", "other")
+        assert not (pathlib.Path(history_repo.working_dir) / "docs/c.py").exists()
+        assert list_repo_files(history_repo) == ["a.py", "b.py", "new.py"]
+
+        seen = []
+        folder_walk(history_repo, lambda *task: seen.append(task[2]))
+        assert sorted(path.split("/")[-1] for path in seen) == [
+            "a.py",
+            "b.py",
+            "new.py",
+        ]
+
+    def test_copy_brand_incremental(self, local_manifest, capsys):
+        Manifest(local_manifest).update_repos()
+        copy_brand("TICKET-3", push=False, manifest_file=local_manifest)
+        state = json.loads(
+            (local_manifest.parent / ".morq/copyright-state.json").read_text()
+        )
+        alpha = git.Repo(local_manifest.parent / "alpha")
+        assert state["alpha"]["commit"] == alpha.head.commit.hexsha
+        capsys.readouterr()
+
+        # Only the files changed since the last run are looked at.
+        (local_manifest.parent / "alpha" / "new.py").write_text("new\n")
+        alpha.index.add(["new.py"])
+        alpha.index.commit("Add new.py")
+        copy_brand("TICKET-3", push=False, manifest_file=local_manifest)
+        out = capsys.readouterr().out
+        assert re.search(r"alpha .*\| 1 .*\| 0 ", out)
+        assert re.search(r"beta .*\| 0 .*\| 0 ", out)
+
+        copy_brand("TICKET-3", push=False, manifest_file=local_manifest, full=True)
+        out = capsys.readouterr().out
+        assert re.search(r"alpha .*\| 0 .*\| 3 ", out)
+
+    def test_copy_brand_filtered_state(self, local_manifest, capsys):
+        Manifest(local_manifest).update_repos()
+        copy_brand(
+            "TICKET-4", push=False, manifest_file=local_manifest, include=["*.txt"]
+        )
+        capsys.readouterr()
+
+        # Files left out by the globs of the last run are not skipped.
+        copy_brand("TICKET-4", push=False, manifest_file=local_manifest)
+        out = capsys.readouterr().out
+        assert re.search(r"alpha .*\| 2 .*\| 0 ", out)
@@ -0,0 +1,127 @@
+"""Test graph module"""
+import json
+import logging
+import re
+
+from orquestra_manifest import graph
+from orquestra_manifest.graph import (
+    get_build_levels,
+    get_dependencies,
+    get_package_requirements,
+    normalize_name,
+)
+from orquestra_manifest.morq import Manifest
+
+logging.basicConfig(level=logging.DEBUG)
+LOG = logging.getLogger()
+
+
+class TestGraph:
+    """Test the graph module"""
+
+    def test_normalize_name(self):
+        assert normalize_name("Orquestra_Quantum") == "orquestra-quantum"
+        assert normalize_name("orquestra.vqa") == "orquestra-vqa"
+
+    def test_get_build_levels(self):
+        dependencies = {
+            "orquestra-quantum": [],
+            "orquestra-opt": ["orquestra-quantum"],
+            "orquestra-vqa": ["orquestra-quantum", "orquestra-opt"],
+            "dummy": [],
+        }
+        levels, cyclic = get_build_levels(dependencies)
+        assert levels == [
+            ["orquestra-quantum", "dummy"],
+            ["orquestra-opt"],
+            ["orquestra-vqa"],
+        ]
+        assert cyclic == []
+
+    def test_get_build_levels_cycle(self, caplog):
+        dependencies = {"a": ["b"], "b": ["a"], "c": ["a"], "d": []}
+        levels, cyclic = get_build_levels(dependencies)
+        assert levels == [["d"]]
+        assert cyclic == ["a", "b", "c"]
+        assert "Dependency cycle" in caplog.text
+
+    def test_get_package_requirements(self, tmp_path):
+        (tmp_path / "setup.cfg").write_text(
+            "[options]\n"
+            "install_requires =\n"
+            "    orquestra-quantum>=0.1\n"
+            "    numpy\n"
+            "    Orquestra_Opt ; python_version>'3.7'\n"
+        )
+        assert get_package_requirements(tmp_path) == {
+            "orquestra-quantum",
+            "numpy",
+            "orquestra-opt",
+        }
+
+    def test_get_package_requirements_no_toml(self, tmp_path, monkeypatch, caplog):
+        """A pyproject.toml that can't be read is reported, not silently skipped"""
+        (tmp_path / "pyproject.toml").write_text(
+            '[project]\ndependencies = ["orquestra-quantum"]\n'
+        )
+        assert get_package_requirements(tmp_path) == {"orquestra-quantum"}
+        monkeypatch.setattr(graph, "tomllib", None)
+        assert get_package_requirements(tmp_path) == set()
+        assert "install tomli" in caplog.text
+
+    def test_get_dependencies(self, local_manifest):
+        manifest = Manifest(local_manifest)
+        (local_manifest.parent / "gamma").mkdir()
+        (local_manifest.parent / "gamma" / "setup.cfg").write_text(
+            "[options]\ninstall_requires =\n    beta\n    alpha\n"
+        )
+        repos = {
+            "alpha": {"depends_on": []},
+            "beta": {"depends_on": ["alpha", "unknown"]},
+            "gamma": {},
+        }
+        assert get_dependencies(manifest, repos) == {
+            "alpha": [],
+            "beta": ["alpha"],
+            "gamma": ["alpha", "beta"],
+        }
+
+    def test_get_dependencies_package_names(self, local_manifest):
+        """Repos are known by the package name they declare, not their folder"""
+        manifest = Manifest(local_manifest)
+        for name, text in (
+            ("alpha", "[metadata]\nname = Alpha_Core\n"),
+            ("gamma", "[options]\ninstall_requires =\n    alpha-core\n    beta\n"),
+        ):
+            (local_manifest.parent / name).mkdir()
+            (local_manifest.parent / name / "setup.cfg").write_text(text)
+        (local_manifest.parent / "beta").mkdir()
+        (local_manifest.parent / "beta" / "pyproject.toml").write_text(
+            '[project]\nname = "beta-lib"\n'
+        )
+        repos = {"alpha": {}, "beta": {}, "gamma": {}}
+        assert get_dependencies(manifest, repos) == {
+            "alpha": [],
+            "beta": [],
+            "gamma": ["alpha"],
+        }
+
+    def test_build_blocked_and_cycle(self, local_manifest, capsys):
+        data = json.loads(local_manifest.read_text())
+        data["repos"]["gamma"]["depends_on"] = ["alpha"]
+        data["repos"]["beta"]["depends_on"] = ["missing"]
+        data["repos"]["missing"]["depends_on"] = ["beta"]
+        local_manifest.write_text(json.dumps(data))
+
+        manifest = Manifest(local_manifest, jobs=4)
+        manifest.update_repos()
+        (local_manifest.parent / "alpha" / "Makefile").write_text("install:\n\tfalse\n")
+        capsys.readouterr()
+
+        total_error = manifest.build_repos()
+        out = capsys.readouterr().out
+        assert re.search(r"alpha.*Failed", out)
+        assert re.search(r"beta.*Cycle", out)
+        assert re.search(r"gamma.*Blocked", out)
+        assert re.search(r"missing.*Cycle", out)
+        assert total_error == 2 + 1 + 10 + 10
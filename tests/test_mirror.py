@@ -0,0 +1,86 @@
+"""Test mirror module"""
+import logging
+import types
+
+import git
+import pytest
+from conftest import make_remote, push_commit
+from git.exc import GitCommandError
+
+from orquestra_manifest import mirror
+from orquestra_manifest.mirror import clone_repo, get_mirror_path, get_mirror_root
+
+logging.basicConfig(level=logging.DEBUG)
+LOG = logging.getLogger()
+
+
+class TestMirror:
+    """Test the mirror module"""
+
+    @pytest.fixture
+    def remote_url(self, tmp_path, git_identity, mirrors):
+        """The url of a local bare repo"""
+        return make_remote(tmp_path, "alpha").as_uri()
+
+    def test_get_mirror_path(self, mirrors):
+        assert get_mirror_root() == mirrors
+        path = get_mirror_path("git@github.com:org/alpha.git")
+        assert path.parent == mirrors
+        assert path.suffix == ".git"
+        assert path == get_mirror_path("git@github.com:org/alpha.git")
+        assert path != get_mirror_path("git@github.com:org/beta.git")
+
+    def test_mirror_lock_windows(self, mirrors, monkeypatch):
+        """Mirrors are locked with msvcrt where there is no fcntl"""
+        calls = []
+        msvcrt = types.SimpleNamespace(
+            LK_LOCK=1, LK_UNLCK=0, locking=lambda *args: calls.append(args[1:])
+        )
+        monkeypatch.setattr(mirror, "fcntl", None)
+        monkeypatch.setattr(mirror, "msvcrt", msvcrt, raising=False)
+        with mirror.mirror_lock(get_mirror_path("git@github.com:org/alpha.git")):
+            assert calls == [(1, 1)]
+        assert calls == [(1, 1), (0, 1)]
+
+    def test_clone_repo(self, tmp_path, remote_url):
+        repo = clone_repo(remote_url, tmp_path / "one")
+        assert repo.remotes.origin.url == remote_url
+        assert get_mirror_path(remote_url).is_dir()
+        objects = (tmp_path / "one" / ".git" / "objects").rglob("*")
+        assert any(path.is_file() and path.stat().st_nlink > 1 for path in objects)
+
+        # The mirror is refreshed before the next clone.
+        push_commit(tmp_path, "alpha")
+        repo = clone_repo(remote_url, tmp_path / "two")
+        assert repo.head.commit.message == "Change change.txt"
+        assert git.Repo(tmp_path / "one").head.commit != repo.head.commit
+
+    def test_clone_repo_shallow_and_partial(self, tmp_path, remote_url):
+        push_commit(tmp_path, "alpha")
+        repo = clone_repo(remote_url, tmp_path / "shallow", dict(depth=1))
+        assert repo.git.rev_parse("--is-shallow-repository") == "true"
+        assert len(list(repo.iter_commits())) == 1
+        assert repo.remotes.origin.url == remote_url
+
+        repo = clone_repo(remote_url, tmp_path / "partial", dict(filter="blob:none"))
+        assert repo.git.config("remote.origin.promisor") == "true"
+        assert len(list(repo.iter_commits())) == 2
+        # The mirror would hold the full history.
+        assert not get_mirror_path(remote_url).exists()
+
+    def test_clone_repo_bad_mirror(self, tmp_path, remote_url, monkeypatch):
+        """A mirror that can't be cloned falls back to a clone of the url"""
+        bad_mirror = tmp_path / "bad.git"
+        bad_mirror.mkdir()
+        monkeypatch.setattr(mirror, "update_mirror", lambda url: bad_mirror)
+        repo = clone_repo(remote_url, tmp_path / "fallback")
+        assert repo.remotes.origin.url == remote_url
+        assert (tmp_path / "fallback" / "alpha.py").exists()
+
+    def test_clone_repo_without_mirror(self, tmp_path, remote_url, mirrors):
+        repo = clone_repo(remote_url, tmp_path / "plain", use_mirror=False)
+        assert repo.remotes.origin.url == remote_url
+        assert not mirrors.exists()
+
+        with pytest.raises(GitCommandError):
+            clone_repo((tmp_path / "nowhere.git").as_uri(), tmp_path / "nowhere")
@@ -1,4 +1,6 @@
 """Test morq module"""
+
+import json
 import logging
 import os
 import pathlib
@@ -6,7 +8,9 @@ import sys
 import re
 import tempfile
 
+import git
 import pytest
+from conftest import push_commit
 
 from orquestra_manifest.morq import Manifest
 from orquestra_manifest.utils import copy_package_file, get_package_root
@@ -147,3 +151,348 @@ class TestCommon:
 
         for regex in expected:
             assert re.search(regex, outerr.out)
+
+
+def table_lines(out):
+    """Keep only the Tabler lines of out"""
+    return [line for line in out.splitlines() if line.startswith(("|", "+"))]
+
+
+class TestParallel:
+    """Test the parallel commands against local bare repos"""
+
+    @pytest.fixture(autouse=True)
+    def _pass_fixtures(self, capsys, local_manifest):
+        """Capture system messages, and provide a local manifest."""
+        self.capsys = capsys
+        self.manifest_file = local_manifest
+
+    def run_morq(self, *args):
+        """Run morq with args on the local manifest, return stdout"""
+        sys.argv = ["", "-m", self.manifest_file.as_posix(), *args]
+        output = Manifest().parse_args()
+        assert output is True
+        return self.capsys.readouterr().out
+
+    def test_update_repos_jobs(self):
+        """Parallel update keeps manifest order, and survives a failing repo"""
+        out = self.run_morq("-j", "4", "init")
+        lines = [line for line in out.splitlines() if line.startswith("|")]
+        assert [line.split()[1] for line in lines[1:]] == [
+            "alpha",
+            "beta",
+            "gamma",
+            "missing",
+        ]
+        assert re.search(r"gamma.*OK.*New", out)
+        assert re.search(r"missing.*Invalid", out)
+
+        push_commit(self.manifest_file.parent.parent, "beta")
+        out = self.run_morq("--jobs", "4", "update")
+        assert re.search(r"alpha.*OK.*unchanged", out)
+        assert re.search(r"beta.*OK.*changed", out)
+        assert not re.search(r"beta.*unchanged", out)
+
+    def test_check_repos_jobs(self):
+        """Parallel check reports every repo in manifest order"""
+        self.run_morq("-j", "4", "init")
+        out = self.run_morq("-j", "4", "check")
+        lines = [line for line in out.splitlines() if line.startswith("|")]
+        assert [line.split()[1] for line in lines[1:]] == [
+            "alpha",
+            "beta",
+            "gamma",
+            "missing",
+        ]
+        for name in ("alpha", "beta", "gamma"):
+            assert re.search(rf"{name}.*main.*OK", out)
+        assert re.search(r"missing.*Missing", out)
+
+    def test_build_repos_jobs(self):
+        """Parallel build matches the serial total error and keeps the cwd"""
+        self.run_morq("-j", "4", "init")
+        cwd = os.getcwd()
+
+        serial_error = Manifest(self.manifest_file, use_cache=False).build_repos()
+        serial_out = self.capsys.readouterr().out
+        manifest = Manifest(self.manifest_file, jobs=4, use_cache=False)
+        parallel_error = manifest.build_repos()
+        parallel_out = self.capsys.readouterr().out
+
+        assert os.getcwd() == cwd
+        assert serial_error == parallel_error == 100
+        assert table_lines(serial_out) == table_lines(parallel_out)
+        assert re.search(r"gamma.*OK", parallel_out)
+        assert re.search(r"missing.*Failed", parallel_out)
+
+    def test_build_repos_cache(self):
+        """Unchanged repos are not rebuilt"""
+        self.run_morq("-j", "4", "init")
+        out = self.run_morq("build")
+        assert "Build cache: 0 hits, 4 misses" in out
+        assert (self.manifest_file.parent / ".morq/build-state.json").exists()
+
+        out = self.run_morq("build")
+        assert "Build cache: 3 hits, 1 misses" in out
+        assert re.search(r"alpha.*Cached", out)
+        assert re.search(r"missing.*Failed", out)
+
+        # A dirty tree, or another build command, is a miss.
+        (self.manifest_file.parent / "beta" / "beta.py").write_text("changed\n")
+        out = self.run_morq("build")
+        assert "Build cache: 2 hits, 2 misses" in out
+        assert re.search(r"beta.*OK", out)
+        out = self.run_morq("--no-cache", "build")
+        assert "Build cache" not in out
+        assert not re.search(r"Cached", out)
+
+    def test_repos_affected(self):
+        """Only repos changed since their last green test, or downstream, are tested"""
+        data = json.loads(self.manifest_file.read_text())
+        data["repos"]["beta"]["depends_on"] = ["alpha"]
+        del data["repos"]["missing"]
+        self.manifest_file.write_text(json.dumps(data))
+        self.run_morq("-j", "4", "init")
+
+        out = self.run_morq("test", "--affected")
+        for name in ("alpha", "beta", "gamma"):
+            assert re.search(rf"{name} .*\| OK", out)
+
+        out = self.run_morq("test", "--affected")
+        for name in ("alpha", "beta", "gamma"):
+            assert re.search(rf"{name} .*\| Cached", out)
+        assert "build_dev" not in out
+
+        push_commit(self.manifest_file.parent.parent, "alpha")
+        self.run_morq("update")
+        out = self.run_morq("test", "--affected")
+        assert re.search(r"alpha .*\| OK", out)
+        assert re.search(r"beta .*\| OK", out)
+        assert re.search(r"gamma .*\| Cached", out)
+
+        out = self.run_morq("--no-cache", "test", "--affected")
+        assert not re.search(r"Cached", out)
+
+    def test_check_behind_and_ahead(self):
+        """Check shows both the behind and the ahead counts"""
+        self.run_morq("init")
+        push_commit(self.manifest_file.parent.parent, "alpha")
+        alpha = git.Repo(self.manifest_file.parent / "alpha")
+        alpha.remotes.origin.fetch()
+
+        out = self.run_morq("check")
+        assert re.search(r"alpha .*1 behind / 0 ahead", out)
+        assert Manifest.get_commits_behind_or_ahead(alpha, "main") == (1, 0)
+
+        (self.manifest_file.parent / "alpha" / "local.txt").write_text("local\n")
+        alpha.index.add(["local.txt"])
+        alpha.index.commit("Local change")
+        out = self.run_morq("check")
+        assert re.search(r"alpha .*1 behind / 1 ahead", out)
+        assert Manifest.get_commits_behind_or_ahead(alpha, "main") == (1, 1)
+
+    def test_stream(self):
+        """Streamed rows come first, then the final table in manifest order"""
+        out = self.run_morq("-j", "4", "--stream", "init")
+        streamed, summary = out.split("Summary:")
+        assert len(table_lines(streamed)) == 4 + 4
+        assert sorted(line.split()[1] for line in table_lines(streamed)[3:-1]) == [
+            "alpha",
+            "beta",
+            "gamma",
+            "missing",
+        ]
+        assert [line.split()[1] for line in table_lines(summary)[3:-1]] == [
+            "alpha",
+            "beta",
+            "gamma",
+            "missing",
+        ]
+
+        out = self.run_morq("--stream", "build")
+        streamed, summary = out.split("Summary:")
+        assert re.search(r"gamma .*\| OK", streamed)
+        assert re.search(r"missing .*\| Failed", summary)
+
+    def test_output_formats(self):
+        """Machine readable formats hold the rows alone on stdout"""
+        # Live logging of pytest resets the captured sys.stdout on every record.
+        logging.disable(logging.CRITICAL)
+        try:
+            self.check_output_formats()
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def check_output_formats(self):
+        """Check the output of each format"""
+        rows = [
+            json.loads(line)
+            for line in self.run_morq("--format", "ndjson", "init").splitlines()
+        ]
+        assert sorted(row["folder"] for row in rows) == [
+            "alpha",
+            "beta",
+            "gamma",
+            "missing",
+        ]
+
+        rows = json.loads(self.run_morq("--format", "json", "check"))
+        assert [row["folder"] for row in rows] == ["alpha", "beta", "gamma", "missing"]
+        assert rows[0]["status"] == "OK"
+        assert "\x1b[" not in json.dumps(rows)
+
+        out = self.run_morq("--format", "csv", "list")
+        assert out.splitlines()[0] == "url,ref"
+        assert len(out.splitlines()) == 5
+
+        sys.argv = ["", "-m", self.manifest_file.as_posix(), "--format", "json", "test"]
+        assert Manifest().parse_args() is True
+        outerr = self.capsys.readouterr()
+        rows = json.loads(outerr.out)
+        assert rows[0] == dict(folder="alpha", test="OK")
+        assert "ok" in outerr.err
+
+        # Streamed rows of json and csv show progress on stderr only.
+        for fmt in ("json", "csv"):
+            args = ["", "-m", self.manifest_file.as_posix(), "-j", "4", "--stream"]
+            sys.argv = [*args, "--format", fmt, "check"]
+            assert Manifest().parse_args() is True
+            outerr = self.capsys.readouterr()
+            assert not table_lines(outerr.out)
+            assert re.search(r"\| alpha .*\| OK", outerr.err)
+        assert json.loads(self.run_morq("--stream", "--format", "json", "check"))
+
+    def test_check_cache(self, monkeypatch, caplog):
+        """A repeat check answers from the status cache, until git touches a repo"""
+        self.run_morq("-j", "4", "init")
+        first = table_lines(self.run_morq("-j", "4", "check"))
+        checked = []
+        check_repo = Manifest.check_repo
+
+        def spy(manifest, repo_name, record):
+            checked.append(repo_name)
+            return check_repo(manifest, repo_name, record)
+
+        monkeypatch.setattr(Manifest, "check_repo", spy)
+        assert table_lines(self.run_morq("check")) == first
+        assert checked == ["missing"]
+        assert "Status cache: 3 hits, 1 misses" in caplog.text
+
+        alpha = git.Repo(self.manifest_file.parent / "alpha")
+        (self.manifest_file.parent / "alpha" / "local.txt").write_text("local\n")
+        alpha.index.add(["local.txt"])
+        alpha.index.commit("Local change")
+        checked.clear()
+        out = self.run_morq("check")
+        assert checked == ["alpha", "missing"]
+        assert re.search(r"alpha .*0 behind / 1 ahead", out)
+
+        checked.clear()
+        self.run_morq("--no-cache", "check")
+        assert checked == ["alpha", "beta", "gamma", "missing"]
+
+    def test_profile(self, tmp_path):
+        """--profile times every repo, and writes the git calls and commands too"""
+        trace_path = tmp_path / "trace.json"
+        out = self.run_morq("-j", "4", "--profile", trace_path.as_posix(), "init")
+        lines = table_lines(out)
+        assert lines[1].split("|")[-2].strip() == "seconds"
+        assert re.search(r"alpha .*\| New .*\| \d+\.\d\d", out)
+
+        events = json.loads(trace_path.read_text())["traceEvents"]
+        repos = [event for event in events if event.get("cat") == "repo"]
+        assert sorted(event["name"] for event in repos) == [
+            "alpha",
+            "beta",
+            "gamma",
+            "missing",
+        ]
+        assert {event["args"]["phase"] for event in repos} == {"update_repo"}
+        # Clones are timed until git exits, they are most of the clone phases.
+        clones = [event["dur"] for event in events if event["name"] == "git clone"]
+        phases = [event["dur"] for event in events if event["name"] == "clone"]
+        assert clones
+        assert sum(clones) > sum(phases) / 2
+
+        self.run_morq("--profile", trace_path.as_posix(), "build")
+        events = json.loads(trace_path.read_text())["traceEvents"]
+        commands = [event for event in events if event.get("cat") == "subprocess"]
+        assert sorted(event["args"]["cwd"] for event in commands)[0].endswith("alpha")
+        assert {event["name"] for event in commands} == {"make install"}
+
+        out = self.run_morq("--timings", "check")
+        assert re.search(r"gamma .*\| OK .*\| \d+\.\d\d", out)
+        assert not re.search(r"seconds", self.run_morq("check"))
+
+    def test_fetch_jobs(self, monkeypatch):
+        """fetch runs every repo at once without -j, other commands one at a time"""
+        jobs = []
+        monkeypatch.setattr(Manifest, "fetch_repos", lambda self: jobs.append(self.jobs))
+        monkeypatch.setattr(Manifest, "list_repos", lambda self: jobs.append(self.jobs))
+        self.run_morq("fetch")
+        self.run_morq("-j", "2", "fetch")
+        self.run_morq("list")
+        assert jobs == [0, 2, 1]
+
+    def test_fetch_then_update(self):
+        """fetch only touches remote refs, update --no-fetch fast-forwards"""
+        self.run_morq("-j", "4", "init")
+        push_commit(self.manifest_file.parent.parent, "beta")
+        beta = git.Repo(self.manifest_file.parent / "beta")
+        head = beta.head.commit.hexsha
+
+        out = self.run_morq("-j", "4", "fetch", "--per-host", "2")
+        assert re.search(r"alpha .*\| local .*\| unchanged", out)
+        assert re.search(r"beta .*\| local .*\| changed", out)
+        assert re.search(r"missing .*\| Missing", out)
+        assert beta.head.commit.hexsha == head
+
+        out = self.run_morq("-j", "4", "update", "--no-fetch")
+        assert re.search(r"alpha.*OK.*unchanged", out)
+        assert re.search(r"beta.*OK.*changed", out)
+        assert beta.head.commit.hexsha != head
+        assert beta.head.commit == beta.commit("origin/main")
+
+    def test_shallow_and_sparse(self):
+        """depth and sparse are honored on init and update, check stays exact"""
+        base = self.manifest_file.parent.parent
+        for folder in ("docs", "src"):
+            (base / "seeds" / "beta" / folder).mkdir()
+            push_commit(base, "beta", f"{folder}/index.txt")
+        push_commit(base, "alpha")
+        push_commit(base, "gamma")
+        data = json.loads(self.manifest_file.read_text())
+        data["repos"]["alpha"]["depth"] = 1
+        data["repos"]["beta"]["sparse"] = ["docs"]
+        data["repos"]["gamma"].update(depth=1, ref="v1.0.0")
+        self.manifest_file.write_text(json.dumps(data))
+
+        out = self.run_morq("-j", "4", "init")
+        assert re.search(r"alpha .*\| OK .*\| New", out)
+        assert re.search(r"gamma .*\| OK .*\| New", out)
+        alpha = git.Repo(self.manifest_file.parent / "alpha")
+        assert len(list(alpha.iter_commits())) == 1
+        beta_path = self.manifest_file.parent / "beta"
+        assert (beta_path / "docs" / "index.txt").exists()
+        assert not (beta_path / "src").exists()
+        assert (beta_path / "Makefile").exists()
+
+        # Updates bring the new commits only, so history stays connected.
+        push_commit(base, "alpha", "more.txt")
+        out = self.run_morq("update")
+        assert re.search(r"alpha .*\| OK .*\| changed", out)
+        assert len(list(alpha.iter_commits())) == 2
+        assert alpha.git.rev_parse("--is-shallow-repository") == "true"
+
+        push_commit(base, "alpha", "last.txt")
+        self.run_morq("fetch")
+        out = self.run_morq("check")
+        assert re.search(r"alpha .*1 behind / 0 ahead", out)
+        assert re.search(r"gamma .*\| OK", out)
+
+        # Sparse folders follow the manifest.
+        data["repos"]["beta"]["sparse"] = ["src"]
+        self.manifest_file.write_text(json.dumps(data))
+        self.run_morq("update")
+        assert (beta_path / "src" / "index.txt").exists()
+        assert not (beta_path / "docs").exists()
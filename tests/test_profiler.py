@@ -0,0 +1,78 @@
+"""Test profiler module"""
+import json
+import logging
+import sys
+import threading
+
+import git
+
+from orquestra_manifest import profiler, runner
+from orquestra_manifest.copyright import get_path_years
+
+logging.basicConfig(level=logging.DEBUG)
+LOG = logging.getLogger()
+
+
+class TestProfiler:
+    """Test the profiler module"""
+
+    def test_span_without_profiler(self):
+        assert profiler.get_profiler() is None
+        with profiler.span("idle", "phase"):
+            pass
+        assert profiler.get_profiler() is None
+
+    def test_chrome_trace(self, tmp_path):
+        trace_path = tmp_path / "trace.json"
+
+        def work(name):
+            with profiler.span(name, "repo", phase="test"):
+                pass
+
+        with profiler.profiling(trace_path) as active:
+            threads = [
+                threading.Thread(target=work, args=(f"repo{i}",)) for i in range(3)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert profiler.get_profiler() is active
+        assert profiler.get_profiler() is None
+
+        trace = json.loads(trace_path.read_text())
+        spans = [event for event in trace["traceEvents"] if event["ph"] == "X"]
+        repos = [event for event in spans if event["cat"] == "repo"]
+        assert sorted(event["name"] for event in repos) == ["repo0", "repo1", "repo2"]
+        assert all(event["args"] == {"phase": "test"} for event in repos)
+        (command,) = [event for event in spans if event["cat"] == "command"]
+        assert all(event["dur"] <= command["dur"] for event in spans)
+        threads = [event for event in trace["traceEvents"] if event["ph"] == "M"]
+        assert {event["tid"] for event in threads} == {event["tid"] for event in spans}
+
+    def test_git_and_subprocess_spans(self, tmp_path):
+        repo = git.Repo.init(tmp_path / "repo")
+        execute = git.cmd.Git.execute
+        with profiler.profiling() as active:
+            repo.git.status()
+            runner.run([sys.executable, "-c", "pass"])
+        assert git.cmd.Git.execute is execute
+
+        totals = dict(active.get_totals())
+        assert ("git", "git status") in totals
+        assert ("subprocess", f"{sys.executable} -c pass") in totals
+        assert list(totals)[0] == ("command", "morq")
+
+        (status,) = [event for event in active.events if event["cat"] == "git"]
+        assert status["args"]["repo"] == "repo"
+
+    def test_copyright_git_log_span(self, tmp_path, git_identity):
+        repo = git.Repo.init(tmp_path / "history")
+        (tmp_path / "history" / "a.py").write_text("a\n")
+        repo.index.add(["a.py"])
+        repo.index.commit("Add a.py")
+        with profiler.profiling() as active:
+            assert "a.py" in get_path_years(repo)
+        (log,) = [event for event in active.events if event["name"] == "git log"]
+        assert log["cat"] == "git"
+        assert log["args"]["repo"] == "history"
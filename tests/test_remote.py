@@ -0,0 +1,76 @@
+"""Test remote module"""
+import logging
+import os
+import threading
+
+from orquestra_manifest.remote import HostLimiter, get_remote_host, get_ssh_command
+
+logging.basicConfig(level=logging.DEBUG)
+LOG = logging.getLogger()
+
+
+class TestRemote:
+    """Test the remote module"""
+
+    def test_get_remote_host(self):
+        assert get_remote_host("git@github.com:zapatacomputing/x.git") == "github.com"
+        assert get_remote_host("https://user@gitlab.com:8443/a/b.git") == "gitlab.com"
+        assert get_remote_host("ssh://git@example.org/a.git") == "example.org"
+        assert get_remote_host("file:///tmp/remotes/alpha.git") == "local"
+        assert get_remote_host("/tmp/remotes/alpha.git") == "local"
+        assert get_remote_host(None) == "local"
+
+    def test_get_ssh_command(self, tmp_path, monkeypatch):
+        monkeypatch.delenv("GIT_SSH_COMMAND", raising=False)
+        command = get_ssh_command(tmp_path / "ssh")
+        assert "ControlMaster=auto" in command
+        assert f"ControlPath={tmp_path / 'ssh' / '%C'}" in command
+        assert (tmp_path / "ssh").is_dir()
+
+        monkeypatch.setenv("GIT_SSH_COMMAND", "ssh -i key")
+        assert get_ssh_command(tmp_path / "ssh") == "ssh -i key"
+
+    def test_get_ssh_command_not_private(self, tmp_path, monkeypatch):
+        """Connections are not shared through a folder others can reach"""
+        monkeypatch.delenv("GIT_SSH_COMMAND", raising=False)
+        (tmp_path / "open").mkdir(mode=0o777)
+        (tmp_path / "open").chmod(0o777)
+        assert get_ssh_command(tmp_path / "open") == "ssh"
+
+        (tmp_path / "link").symlink_to(tmp_path / "ssh", target_is_directory=True)
+        (tmp_path / "ssh").mkdir(mode=0o700)
+        assert get_ssh_command(tmp_path / "link") == "ssh"
+
+        monkeypatch.setattr(os, "getuid", lambda: os.stat(tmp_path).st_uid + 1)
+        assert get_ssh_command(tmp_path / "ssh") == "ssh"
+
+    def test_get_ssh_command_windows(self, monkeypatch):
+        monkeypatch.delenv("GIT_SSH_COMMAND", raising=False)
+        monkeypatch.delattr(os, "getuid")
+        assert get_ssh_command() == "ssh"
+
+    def test_host_limiter(self):
+        limiter = HostLimiter(per_host=2)
+        lock = threading.Lock()
+        running = dict(a=0, b=0)
+        peaks = dict(a=0, b=0)
+        # Two threads of a host meet in the block, however slow they start.
+        barriers = {host: threading.Barrier(2, timeout=5) for host in "ab"}
+
+        def work(host):
+            with limiter.limit(host):
+                with lock:
+                    running[host] += 1
+                    peaks[host] = max(peaks[host], running[host])
+                barriers[host].wait()
+                with lock:
+                    running[host] -= 1
+
+        threads = [
+            threading.Thread(target=work, args=(host,)) for host in "aaaaaab" * 2
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert peaks == dict(a=2, b=2)
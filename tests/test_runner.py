@@ -0,0 +1,118 @@
+"""Test runner module"""
+import asyncio
+import errno
+import logging
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from orquestra_manifest import runner
+from orquestra_manifest.utils import folder_cmd, run_command
+
+logging.basicConfig(level=logging.DEBUG)
+LOG = logging.getLogger()
+
+SCRIPT = "import sys; print('out 1'); print('err 1', file=sys.stderr); print('out 2')"
+
+
+class TestRunner:
+    """Test the runner module"""
+
+    def test_run(self):
+        lines = []
+        result = runner.run(
+            [sys.executable, "-c", SCRIPT + "; sys.exit(3)"],
+            on_line=lambda *line: lines.append(line),
+        )
+        assert result.returncode == 3
+        assert not result.timed_out
+        assert [line for line in lines if line[0] == "stdout"] == [
+            ("stdout", "out 1"),
+            ("stdout", "out 2"),
+        ]
+        assert ("stderr", "err 1") in lines
+        assert sorted(result.tail) == sorted(lines)
+
+    def test_bounded_buffers(self, monkeypatch):
+        monkeypatch.setattr(runner, "LINE_LIMIT", 1024)
+        monkeypatch.setattr(runner, "TAIL_LINES", 3)
+        script = "print('x' * 5000); [print(i) for i in range(10)]"
+        lines = []
+        result = runner.run(
+            [sys.executable, "-c", script], on_line=lambda *line: lines.append(line)
+        )
+        assert result.returncode == 0
+        assert "".join(line for _, line in lines[:-10]) == "x" * 5000
+        assert max(len(line) for _, line in lines) <= 1024
+        assert result.tail == [("stdout", "7"), ("stdout", "8"), ("stdout", "9")]
+
+    def test_timeout(self):
+        start = time.perf_counter()
+        result = runner.run(["sleep", "10"], timeout=0.2)
+        assert result.timed_out
+        assert result.returncode == runner.TIMEOUT_ERROR
+        assert time.perf_counter() - start < 5
+
+    @pytest.mark.skipif(not runner.PROCESS_GROUPS, reason="no process groups")
+    def test_timeout_stops_grandchild(self, tmp_path):
+        pid_file = tmp_path / "pid"
+        script = f"sleep 30 & echo $! > {pid_file}; sleep 30"
+        start = time.perf_counter()
+        result = runner.run(["sh", "-c", script], timeout=0.5)
+        assert result.timed_out
+        assert time.perf_counter() - start < runner.KILL_GRACE
+
+        def alive(pid):
+            stat = subprocess.run(
+                ["ps", "-o", "stat=", "-p", pid], capture_output=True, text=True
+            ).stdout.strip()
+            return bool(stat) and not stat.startswith("Z")
+
+        pid = pid_file.read_text().strip()
+        deadline = time.perf_counter() + 5
+        while alive(pid) and time.perf_counter() < deadline:
+            time.sleep(0.05)
+        assert not alive(pid)
+
+    def test_cancel_all(self):
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(runner.run(["sleep", "10"]))
+        )
+        thread.start()
+        while not runner._RUNNING:
+            time.sleep(0.01)
+        assert runner.cancel_all() == 1
+        thread.join(5)
+        assert results[0].returncode < 0
+
+    def test_run_in_event_loop(self, capsys):
+        async def main():
+            return run_command([sys.executable, "-c", SCRIPT], stdout=True)
+
+        assert asyncio.run(main()) == 0
+        out = capsys.readouterr().out.splitlines()
+        assert "out 1" in out
+        assert "out 2" in out
+
+    def test_folder_cmd(self, tmp_path, capsys):
+        folder = tmp_path / "alpha"
+        folder.mkdir()
+        error = folder_cmd(folder, [sys.executable, "-c", SCRIPT], stdout=True)
+        assert error == 0
+        out = capsys.readouterr().out.splitlines()
+        assert out[0] == "[alpha] out 1"
+        assert "[alpha] err 1" in out
+        assert folder_cmd(folder, ["sleep", "10"], timeout=0.1) == 124
+
+    def test_folder_cmd_start_error(self, tmp_path, monkeypatch):
+        assert folder_cmd(tmp_path, ["no-such-command-here"]) == errno.ENOENT
+
+        def fail(*_args, **_kwargs):
+            raise RuntimeError("No child watcher")
+
+        monkeypatch.setattr(runner, "run", fail)
+        assert folder_cmd(tmp_path, ["true"]) == runner.START_ERROR
@@ -0,0 +1,86 @@
+"""Test tabler module"""
+import io
+import json
+import logging
+
+import pytest
+from clint.textui import colored
+
+from orquestra_manifest.tabler import Tabler
+
+logging.basicConfig(level=logging.DEBUG)
+LOG = logging.getLogger()
+
+
+class TestTabler:
+    """Test the Tabler class"""
+
+    def test_get_table(self):
+        tabler = Tabler()
+        tabler.push_datum(dict(folder="alpha", status="Missing"))
+        tabler.push_datum(dict(folder="beta-long", status="OK"))
+        lines = tabler.get_table().splitlines()
+        assert lines[0] == "+-----------+---------+"
+        assert lines[1] == "| folder    | status  |"
+        assert lines[3].startswith("| alpha     |")
+        assert len(lines) == 6
+
+    def test_stream_datum(self):
+        output = io.StringIO()
+        tabler = Tabler(widths=dict(folder=6))
+        tabler.stream_datum(dict(folder="alpha", status="OK"), file=output)
+        lines = output.getvalue().splitlines()
+        assert lines == [
+            "+--------+--------+",
+            "| folder | status |",
+            "+--------+--------+",
+            lines[3],
+        ]
+        assert lines[3].startswith("| alpha  |")
+
+        # A wider row widens the columns from now on.
+        tabler.stream_datum(dict(folder="gamma", status="3 behind"), file=output)
+        tabler.stream_end(file=output)
+        lines = output.getvalue().splitlines()
+        assert lines[4].startswith("| gamma  |")
+        assert "3 behind |" in lines[4]
+        assert lines[5] == "+--------+----------+"
+        assert len(tabler.data) == 2
+
+    def test_color_words(self, monkeypatch):
+        monkeypatch.setattr(colored, "DISABLE_COLOR", False)
+        tabler = Tabler()
+        tabler.push_datum(dict(folder="OK", status="Missing"))
+        tabler.push_datum(dict(folder="NOK", status="3 behind"))
+        lines = tabler.data_lines().splitlines()
+        assert lines[0] == tabler.color_word(
+            "red", "Missing", tabler.color_word("green", "OK", lines[0])
+        )
+        assert str(colored.red("Missing")) in lines[0]
+        assert "\x1b[" not in lines[1]
+        assert tabler.widths == dict(folder=6, status=8)
+
+    def test_render(self):
+        tabler = Tabler()
+        assert tabler.render("json") == "[]\n"
+        assert tabler.render("csv") == ""
+        tabler.push_datum(dict(folder="alpha", status="OK", extra=1))
+        tabler.push_datum(dict(folder="beta, gamma", status=None))
+        assert json.loads(tabler.render("json")) == [
+            dict(folder="alpha", status="OK", extra=1),
+            dict(folder="beta, gamma", status=None, extra=None),
+        ]
+        assert tabler.render("ndjson").splitlines()[1] == (
+            '{"folder": "beta, gamma", "status": null, "extra": null}'
+        )
+        assert tabler.render("csv") == (
+            'folder,status,extra\nalpha,OK,1\n"beta, gamma",,\n'
+        )
+        with pytest.raises(ValueError):
+            tabler.render("xml")
+
+        output = io.StringIO()
+        tabler.stream_datum(
+            dict(folder="delta", status="OK"), file=output, fmt="ndjson"
+        )
+        assert json.loads(output.getvalue())["folder"] == "delta"
@@ -1,23 +1,44 @@
 """Test utils module"""
+import gc
 import logging
 import os
 import pathlib
+import sys
 import tempfile
+import weakref
 
 import git
 import pytest
+from conftest import make_remote, push_commit
 
+from orquestra_manifest.morq import Manifest
 from orquestra_manifest.utils import (
+    RefType,
     _HashCache,
     _print_unique,
     add_line_to_file,
     copy_package_file,
+    fetch_ref,
     get_package_file,
     get_package_root,
+    get_ref_index,
+    get_repo_ref_state_ok,
+    get_repo_ref_type,
+    get_repo_state,
+    get_tag,
+    get_tag_name,
     git_pull_change,
     index_of_line_in_file,
+    invalidate_ref_index,
+    is_shallow,
+    message_scope,
+    ref_in_refs,
+    ref_is_branch,
+    ref_is_commit,
+    ref_is_tag,
     rm_tree,
     run_command,
+    set_sparse,
 )
 
 logging.basicConfig(level=logging.DEBUG)
@@ -117,6 +138,52 @@ class TestUtils:
         seen = H.has_element(1)
         assert seen is True
 
+    def test_HashCache_bounds(self):
+        H = _HashCache(maxsize=2)
+        assert not H.has_element(1)
+        assert not H.has_element(2)
+        assert H.has_element(1)
+        # 2 is the least recently seen, it goes first.
+        assert not H.has_element(3)
+        assert H.has_element(1)
+        assert not H.has_element(2)
+        assert H.suppressed == 2
+        assert H.summary() == "Suppressed 2 repeated messages"
+        H.clear()
+        assert (len(H.cache), H.suppressed) == (0, 0)
+        assert _HashCache().cache is not H.cache
+
+    def test_message_scope(self):
+        with message_scope() as messages:
+            _print_unique("hello_scope")
+            _print_unique("hello_scope")
+            run_command(["cat", "nowhere"])
+            run_command(["cat", "nowhere"])
+            run_command(["cat", "nowhere"], hashcache=_HashCache())
+        out, err = self.capsys.readouterr()
+        assert out.count("hello_scope") == 1
+        assert out.count("No such file") == 2
+        assert messages.suppressed == 2
+
+        # A new scope starts over.
+        with message_scope():
+            _print_unique("hello_scope")
+        out, err = self.capsys.readouterr()
+        assert "hello_scope" in out
+
+    def test_repeated_lines(self):
+        script = "import sys; [print('Traceback', '', i, sep='\\n', file=sys.stderr) for i in (1, 2)]"
+        more = "; print(3, file=sys.stderr)"
+        with message_scope() as messages:
+            run_command([sys.executable, "-c", script])
+            run_command([sys.executable, "-c", script])
+            run_command([sys.executable, "-c", script + more])
+        out, err = self.capsys.readouterr()
+        # Repeated lines are kept, a repeated whole output is not.
+        once = ["Traceback", "", "1", "Traceback", "", "2"]
+        assert out.splitlines() == once + once + ["3"]
+        assert messages.suppressed == 1
+
     def test_print_unique(self):
         _print_unique("hello_unique")
         out, err = self.capsys.readouterr()
@@ -151,3 +218,149 @@ class TestUtils:
         run_command(command, verbose=False)
         out, err = self.capsys.readouterr()
         assert "No such file" in out
+
+    def test_ref_index(self, tmp_path, git_identity):
+        remote = make_remote(tmp_path, "refs")
+        repo = git.Repo.clone_from(remote.as_uri(), tmp_path / "refs")
+        repo.create_tag("annotated", message="An annotated tag")
+        head = repo.head.commit.hexsha
+
+        ref_index = get_ref_index(repo)
+        assert ref_index is get_ref_index(repo)
+        assert ref_index.tags == {"v1.0.0": head, "annotated": head}
+        assert {"main", "origin/main", "remotes/origin/main"} <= ref_index.branches
+        assert "origin/HEAD" not in ref_index.branches
+
+        assert ref_in_refs(repo, "main")
+        assert ref_in_refs(repo, "v1.0.0")
+        assert not ref_in_refs(repo, "nope")
+        assert ref_is_branch(repo, "main")
+        assert not ref_is_branch(repo, "v1.0.0")
+        assert ref_is_tag(repo, "annotated")
+        assert ref_is_commit(repo, head[:8])
+        assert not ref_is_commit(repo, "main")
+        assert not ref_is_commit(repo, "nope")
+        assert ref_index.resolve("main") == head
+
+        assert get_repo_ref_type(repo, "main") == RefType.BRANCH
+        assert get_repo_ref_type(repo, "v1.0.0") == RefType.TAG
+        assert get_repo_ref_type(repo, head) == RefType.COMMIT
+        assert get_repo_ref_type(repo, "nope") == RefType.UNKNOWN
+
+        repo.create_head("feature")
+        invalidate_ref_index(repo)
+        assert ref_is_branch(repo, "feature")
+
+        # Each git.Repo has its own index, and the index does not keep it alive.
+        ref_index = get_ref_index(repo)
+        other = git.Repo(tmp_path / "refs")
+        assert get_ref_index(other) is not ref_index
+        assert get_ref_index(repo) is ref_index
+        assert get_ref_index(other).repo is other
+        released = weakref.ref(other)
+        del other
+        gc.collect()
+        assert released() is None
+
+    def test_get_repo_state(self, tmp_path, git_identity):
+        remote = make_remote(tmp_path, "state")
+        repo = git.Repo.clone_from(remote.as_uri(), tmp_path / "state")
+        head = repo.head.commit.hexsha
+
+        state = get_repo_state(repo, "main")
+        assert state.ref_type == RefType.BRANCH
+        assert (state.head_sha, state.ref_sha) == (head, head)
+        assert state.head_ref == "refs/heads/main"
+        assert (state.ahead, state.behind, state.dirty) == (0, 0, False)
+        assert state.ok and get_repo_ref_state_ok(repo, "main")
+
+        # Behind: the remote moved on.
+        push_commit(tmp_path, "state")
+        repo.remotes.origin.fetch()
+        invalidate_ref_index(repo)
+        state = get_repo_state(repo, "main")
+        assert (state.ahead, state.behind) == (0, 1)
+        assert not state.ok
+
+        # Ahead and behind, and dirty.
+        (tmp_path / "state" / "local.txt").write_text("local\n")
+        repo.index.add(["local.txt"])
+        repo.index.commit("Local change")
+        (tmp_path / "state" / "state.py").write_text("dirty\n")
+        state = get_repo_state(repo, "main")
+        assert (state.ahead, state.behind, state.dirty) == (1, 1, True)
+        assert get_repo_state(repo, "main", check_dirty=False).dirty is None
+
+        # Tags and commits are detached.
+        repo.git.checkout("--force", "v1.0.0")
+        state = get_repo_state(repo, "v1.0.0")
+        assert state.ref_type == RefType.TAG and state.head_ref == "HEAD"
+        assert state.ok
+        assert get_repo_state(repo, head[:10]).ok
+        assert get_repo_state(repo, "nope").ref_type == RefType.UNKNOWN
+        assert not get_repo_ref_state_ok(repo, "main")
+
+    def test_get_tag(self, tmp_path, git_identity):
+        remote = make_remote(tmp_path, "tags")
+        repo = git.Repo.clone_from(remote.as_uri(), tmp_path / "tags")
+        repo.create_tag("annotated", message="An annotated tag")
+
+        assert get_tag_name(repo) == "annotated"
+        assert Manifest.get_current_tag(repo) == "annotated"
+        tag = get_tag(repo)
+        assert tag.name == "annotated"
+        assert tag.commit == repo.head.commit
+
+        push_commit(tmp_path, "tags")
+        repo.remotes.origin.pull("main")
+        invalidate_ref_index(repo)
+        assert get_tag(repo) is None
+        assert get_tag_name(repo) is None
+
+    def test_shallow_repo(self, tmp_path, git_identity):
+        remote = make_remote(tmp_path, "shallow")
+        push_commit(tmp_path, "shallow")
+        repo = git.Repo.clone_from(remote.as_uri(), tmp_path / "shallow", depth=1)
+        assert is_shallow(repo)
+        assert not ref_in_refs(repo, "v1.0.0")
+        assert fetch_ref(repo, "v1.0.0", depth=1)
+        assert ref_is_tag(repo, "v1.0.0")
+        assert not fetch_ref(repo, "nope")
+
+        # A history cut before the merge base gives lower bounds.
+        push_commit(tmp_path, "shallow", "more.txt")
+        repo.git.fetch("--depth=1", "origin")
+        (tmp_path / "shallow" / "local.txt").write_text("local\n")
+        repo.index.add(["local.txt"])
+        repo.index.commit("Local change")
+        invalidate_ref_index(repo)
+        state = get_repo_state(repo, "main")
+        assert (state.ahead, state.behind, state.exact) == (2, 1, False)
+        assert Manifest.format_commit_delta(state) == "1+ behind / 2+ ahead"
+
+    def test_set_sparse(self, tmp_path, git_identity):
+        remote = make_remote(tmp_path, "sparse")
+        (tmp_path / "seeds" / "sparse" / "docs").mkdir()
+        push_commit(tmp_path, "sparse", "docs/index.txt")
+        repo = git.Repo.clone_from(remote.as_uri(), tmp_path / "sparse")
+        assert not set_sparse(repo, None)
+
+        assert set_sparse(repo, ["/other/"])
+        assert not (tmp_path / "sparse" / "docs").exists()
+        assert (tmp_path / "sparse" / "sparse.py").exists()
+        assert not set_sparse(repo, ["other"])
+
+        assert set_sparse(repo, [])
+        assert (tmp_path / "sparse" / "docs" / "index.txt").exists()
+
+        # Non-cone patterns, as plain 'set' writes before git 2.37, drop top files.
+        repo.git.sparse_checkout("set", "--no-cone", "/docs/")
+        assert not (tmp_path / "sparse" / "Makefile").exists()
+        assert set_sparse(repo, ["docs"])
+        assert (tmp_path / "sparse" / "Makefile").exists()
+        assert repo.git.config("--bool", "core.sparseCheckoutCone") == "true"
+        assert not set_sparse(repo, ["docs"])
+
+        # The order of the folders does not matter.
+        assert set_sparse(repo, ["other", "docs"])
+        assert not set_sparse(repo, ["other", "docs"])